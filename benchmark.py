@@ -0,0 +1,287 @@
+"""Офлайн-бенчмарк цикла scheduled_check.
+
+Поднимает локальную замену api.kufar.by с синтетическими объявлениями,
+заполняет временную базу подписчиками и фильтрами и прогоняет один цикл
+с ботом-заглушкой, который только записывает send_message.
+
+Каждый размер запускается в отдельном процессе, чтобы пиковый RSS не
+смешивался между прогонами:
+
+    python benchmark.py --users 1000 10000 100000 --output bench.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import platform
+import subprocess
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+METRO_STATIONS = [
+    "Малиновка", "Петровщина", "Михалово", "Грушевка", "Институт культуры",
+    "Площадь Ленина", "Октябрьская", "Площадь Победы", "Площадь Якуба Коласа",
+    "Академия наук", "Парк Челюскинцев", "Московская", "Восток", "Борисовский тракт",
+    "Уручье", "Каменная горка", "Кунцевщина", "Спортивная", "Пушкинская", "Молодёжная",
+    "Фрунзенская", "Немига", "Купаловская", "Первомайская", "Пролетарская",
+    "Тракторный завод", "Партизанская", "Автозаводская", "Могилёвская",
+]
+
+
+def generate_ads(count, seed):
+    """Синтетические объявления в формате rendered-paginated, от новых к старым."""
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    ads = []
+    for i in range(count):
+        rooms = rng.randint(1, 4)
+        ads.append({
+            "ad_id": 900000000 + count - i,
+            "subject": f"{rooms}-комнатная квартира",
+            "price_byn": str(rng.randint(300, 4000) * 100),
+            "list_time": (now - timedelta(seconds=30 * i)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "ad_link": f"https://re.kufar.by/vi/{900000000 + count - i}",
+            "location": {"metro": rng.choice(METRO_STATIONS)},
+            "ad_parameters": [
+                {"p": "rooms", "v": str(rooms)},
+                {"p": "coordinates", "v": [27.4 + rng.random() * 0.3, 53.8 + rng.random() * 0.15]},
+            ],
+        })
+    return ads
+
+
+class FakeKufarHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/search-api/v2/search/rendered-paginated":
+            self.send_error(404)
+            return
+        query = parse_qs(url.query)
+        size = int(query.get("size", ["30"])[0])
+        page = int(query.get("cursor", ["0"])[0])
+        ads = self.server.ads[page * size:(page + 1) * size]
+        pages = []
+        if (page + 1) * size < len(self.server.ads):
+            pages.append({"label": "next", "token": str(page + 1)})
+        body = json.dumps({"ads": ads, "pagination": {"pages": pages}}).encode()
+        self.server.requests += 1
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_kufar(ads):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeKufarHandler)
+    server.ads = ads
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class StubBot:
+    """Заглушка Telegram-бота: запоминает отправки, опционально с задержкой."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent.append((chat_id, len(text)))
+
+
+class StubApplication:
+    def __init__(self, bot):
+        self.bot = bot
+
+
+class Timer:
+    """Суммирует время, проведённое в обёрнутых корутинах."""
+
+    def __init__(self):
+        self.total = 0.0
+        self.calls = 0
+
+    def wrap_async(self, func):
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.total += time.perf_counter() - started
+                self.calls += 1
+        return wrapper
+
+    def wrap(self, func):
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.total += time.perf_counter() - started
+                self.calls += 1
+        return wrapper
+
+
+def seed_rows(users, seed):
+    rng = random.Random(seed)
+    subscribers = []
+    filters = []
+    for i in range(users):
+        chat_id = 10_000_000 + i
+        subscribers.append((chat_id,))
+        min_price = rng.choice([None, None, rng.randint(300, 1500)])
+        max_price = rng.choice([None, rng.randint(1500, 4000)])
+        rooms = rng.choice([None, None, None, rng.randint(1, 4)])
+        metro = rng.choice([None, None, None, None, rng.choice(METRO_STATIONS)])
+        if any(value is not None for value in (min_price, max_price, rooms, metro)):
+            filters.append((chat_id, min_price, max_price, rooms, metro))
+    return subscribers, filters
+
+
+async def run_cycle(args):
+    import parsertest3 as bot
+
+    db_pool = await bot.DatabasePool.get_instance(args.db_path)
+    await bot.init_db()
+
+    subscribers, filters = seed_rows(args.users, args.seed)
+    async with db_pool.transaction():
+        await db_pool.executemany("INSERT INTO subscribers (chat_id) VALUES (?)", subscribers)
+        await db_pool.executemany(
+            "INSERT INTO user_filters (user_id, min_price, max_price, rooms, metro) VALUES (?, ?, ?, ?, ?)",
+            filters,
+        )
+    # Водяной знак на самом старом объявлении заставляет обойти все страницы
+    params = bot.search_params("minsk")
+    oldest = args.ads_list[-1]
+    await bot.save_watermark(bot.search_query_key(params), str(oldest["ad_id"]), oldest["list_time"])
+    await bot.FilterCache.get_instance()
+
+    db_timer, match_timer, fetch_timer = Timer(), Timer(), Timer()
+    db_pool.execute = db_timer.wrap_async(db_pool.execute)
+    db_pool.executemany = db_timer.wrap_async(db_pool.executemany)
+    bot.get_listings = fetch_timer.wrap_async(bot.get_listings)
+    bot.SubscriptionIndex.route = match_timer.wrap(bot.SubscriptionIndex.route)
+
+    stub_bot = StubBot(args.send_latency)
+    app = StubApplication(stub_bot)
+
+    started = time.perf_counter()
+    await bot.scheduled_check(app)
+    cycle_seconds = time.perf_counter() - started
+
+    send_started = time.perf_counter()
+    dispatcher = bot.NotificationDispatcher.get_instance()
+    await dispatcher.queue.join()
+    drain_seconds = time.perf_counter() - send_started
+    total_seconds = time.perf_counter() - started
+
+    await dispatcher.close()
+    await bot.KufarClient.get_instance().close()
+    await db_pool.close()
+
+    return {
+        "users": args.users,
+        "ads": len(args.ads_list),
+        "cycle_seconds": round(cycle_seconds, 4),
+        "fetch_seconds": round(fetch_timer.total, 4),
+        "match_seconds": round(match_timer.total, 4),
+        "db_seconds": round(db_timer.total, 4),
+        "db_calls": db_timer.calls,
+        "messages_sent": len(stub_bot.sent),
+        "send_drain_seconds": round(drain_seconds, 4),
+        "send_throughput_per_second": round(len(stub_bot.sent) / total_seconds, 1) if total_seconds else None,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_one(args):
+    """Один прогон в текущем процессе; результат печатается в stdout как JSON."""
+    args.ads_list = generate_ads(args.ads, args.seed)
+    server = start_fake_kufar(args.ads_list)
+    with tempfile.TemporaryDirectory() as tmp:
+        args.db_path = os.path.join(tmp, "bench.db")
+        os.environ["KUFAR_BASE_URL"] = f"http://127.0.0.1:{server.server_port}"
+        os.environ.setdefault("KUFAR_MAX_PAGES", str(args.ads // 30 + 1))
+        os.environ.setdefault("TELEGRAM_GLOBAL_RATE", str(args.telegram_rate))
+        os.environ.setdefault("TELEGRAM_CHAT_RATE", str(args.telegram_rate))
+        os.environ.setdefault("NOTIFY_QUEUE_SIZE", str(max(10000, args.users)))
+        result = asyncio.run(run_cycle(args))
+    result["kufar_requests"] = server.requests
+    server.shutdown()
+    print(json.dumps(result))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), text=True, stderr=subprocess.DEVNULL,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--ads", type=int, default=300, help="число синтетических объявлений в выдаче")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--send-latency", type=float, default=0.0, help="задержка заглушки send_message, с")
+    parser.add_argument("--telegram-rate", type=float, default=1e6, help="лимит отправок в секунду")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--run-one", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        args.users = args.users[0]
+        run_one(args)
+        return
+
+    results = []
+    for users in args.users:
+        command = [
+            sys.executable, os.path.abspath(__file__), "--run-one",
+            "--users", str(users), "--ads", str(args.ads), "--seed", str(args.seed),
+            "--send-latency", str(args.send_latency), "--telegram-rate", str(args.telegram_rate),
+        ]
+        completed = subprocess.run(command, capture_output=True, text=True, check=True)
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        print(f"{users} пользователей: цикл {result['cycle_seconds']} с, "
+              f"БД {result['db_seconds']} с, матчинг {result['match_seconds']} с, "
+              f"{result['send_throughput_per_second']} сообщ./с, RSS {result['peak_rss_kb']} КБ")
+        results.append(result)
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {"ads": args.ads, "seed": args.seed, "send_latency": args.send_latency,
+                   "telegram_rate": args.telegram_rate},
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {args.output}")
+
+
+if __name__ == "__main__":
+    main()
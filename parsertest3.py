@@ -1,20 +1,41 @@
 import os
 import sys
 import logging
+import logging.handlers
+import re
+import time
+import json
+import math
+import difflib
+import hmac
+import hashlib
+import signal
 import asyncio
-from telegram import ReplyKeyboardMarkup, Update
+import argparse
+import contextvars
+import multiprocessing
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
+from dataclasses import dataclass, fields, replace
+from itertools import chain
+from types import SimpleNamespace
+from telegram import Bot, ReplyKeyboardMarkup, Update
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
 from telegram.ext import (
     ApplicationBuilder,
+    BasePersistence,
     CommandHandler,
     MessageHandler,
     filters,
     ContextTypes,
     ConversationHandler,
+    PersistenceInput,
 )
 import aiosqlite
 from dotenv import load_dotenv
 import nest_asyncio
-import requests
+import httpx
 
 # Apply async policy for Windows compatibility
 if sys.platform.startswith('win'):
@@ -23,47 +44,520 @@ if sys.platform.startswith('win'):
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        for key, value in self.values.items():
+            yield f"{self.name}{format_labels(key)} {value}"
+
+class Gauge:
+    """Значение считывается функцией в момент выдачи метрик."""
+
+    def __init__(self, name: str, help_text: str, read):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {float(self.read())}"
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+        counts = entry[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        entry[1] += 1
+        entry[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        for key, (counts, count, total) in self.values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket{format_labels(key + (('le', bound),))} {bucket_count}"
+            yield f"{self.name}_bucket{format_labels(key + (('le', '+Inf'),))} {count}"
+            yield f"{self.name}_sum{format_labels(key)} {total}"
+            yield f"{self.name}_count{format_labels(key)} {count}"
+
+def format_labels(key):
+    if not key:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ') for _, value in key)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(key, escaped)) + "}"
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text):
+        return self._register(Counter(name, help_text))
+
+    def histogram(self, name, help_text, **kwargs):
+        return self._register(Histogram(name, help_text, **kwargs))
+
+    def gauge(self, name, help_text, read):
+        return self._register(Gauge(name, help_text, read))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logging.warning(f"Не удалось прочитать метрику {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+METRICS = MetricsRegistry()
+KUFAR_REQUEST_SECONDS = METRICS.histogram("parsbot_kufar_request_seconds", "Kufar API request latency")
+KUFAR_REQUESTS = METRICS.counter("parsbot_kufar_requests_total", "Kufar API requests by HTTP status")
+ADS_FETCHED = METRICS.counter("parsbot_ads_fetched_total", "Ads received from Kufar result pages")
+ADS_NEW = METRICS.counter("parsbot_ads_new_total", "Ads newer than the crawl watermark")
+DELIVERIES = METRICS.counter("parsbot_deliveries_total", "New (user, ad) deliveries recorded")
+STAGE_SECONDS = METRICS.histogram("parsbot_stage_seconds", "Pipeline stage duration")
+CYCLES = METRICS.counter("parsbot_cycles_total", "Scheduling cycles by outcome")
+DB_QUERY_SECONDS = METRICS.histogram("parsbot_db_query_seconds", "SQLite statement latency including pool wait")
+MESSAGES_SENT = METRICS.counter("parsbot_telegram_messages_sent_total", "Messages delivered to Telegram")
+TELEGRAM_ERRORS = METRICS.counter("parsbot_telegram_errors_total", "Telegram send errors by kind")
+WEBHOOK_REQUESTS = METRICS.counter("parsbot_webhook_requests_total", "Webhook requests by HTTP status")
+
+# Таймеры текущего цикла для JSON-строки в логе
+current_cycle = contextvars.ContextVar("current_cycle", default=None)
+
+@contextmanager
+def stage(name: str):
+    """Замеряет этап конвейера: в гистограмму и в отчёт текущего цикла."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        cycle = current_cycle.get()
+        if cycle is not None:
+            cycle["stages"][name] = round(cycle["stages"].get(name, 0.0) + elapsed, 4)
+
+def cycle_count(name: str, amount: int):
+    cycle = current_cycle.get()
+    if cycle is not None:
+        cycle["counts"][name] = cycle["counts"].get(name, 0) + amount
+
+def statement_label(query: str):
+    return " ".join(query.split())[:80]
+
+async def handle_metrics_request(reader, writer):
+    try:
+        request_line = await reader.readline()
+        # Заголовки запроса не нужны, но их надо дочитать
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        if request_line.split(b" ")[1:2] == [b"/metrics"]:
+            body = METRICS.render().encode()
+            status = "200 OK"
+        else:
+            body = b"not found\n"
+            status = "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    """Запускает эндпоинт /metrics в формате Prometheus, если задан METRICS_PORT."""
+    port = os.getenv('METRICS_PORT')
+    if not port:
+        return None
+    host = os.getenv('METRICS_HOST', '127.0.0.1')
+    server = await asyncio.start_server(handle_metrics_request, host, int(port))
+    logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return server
+
+class WebhookServer:
+    """Приём обновлений Telegram через вебхук на встроенном asyncio-сервере.
+
+    Работает в том же цикле событий, что и планировщик. Принятое обновление
+    кладётся в update_queue приложения. Обновления обрабатываются по одному:
+    ConversationHandler и user_data не рассчитаны на параллельные сообщения
+    одного пользователя. Пока обработчик занят, очередь заполняется, и при
+    заполнении ответ Telegram задерживается, а не копятся задачи.
+    """
+
+    def __init__(self, app, listen: str, port: int, path: str, secret: str | None, max_body: int):
+        self.app = app
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.max_body = max_body
+        self.server = None
+
+    @classmethod
+    def from_env(cls, app):
+        return cls(
+            app,
+            listen=os.getenv('WEBHOOK_LISTEN', '0.0.0.0'),
+            port=int(os.getenv('WEBHOOK_PORT', 8443)),
+            path=os.getenv('WEBHOOK_PATH', '/telegram'),
+            secret=os.getenv('WEBHOOK_SECRET') or None,
+            max_body=int(os.getenv('WEBHOOK_MAX_BODY', 1 << 20)),
+        )
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.listen, self.port)
+        logging.info(f"Вебхук слушает http://{self.listen}:{self.port}{self.path}")
+
+    def close(self):
+        if self.server:
+            self.server.close()
+
+    async def _respond(self, writer, status, body=b""):
+        WEBHOOK_REQUESTS.inc(status=status.split()[0])
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        try:
+            method, target, *_ = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                name, _, value = line.decode('latin-1').partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            if target.split("?")[0] != self.path:
+                return await self._respond(writer, "404 Not Found")
+            if method != "POST":
+                return await self._respond(writer, "405 Method Not Allowed")
+            if self.secret and not hmac.compare_digest(
+                headers.get("x-telegram-bot-api-secret-token", ""), self.secret
+            ):
+                return await self._respond(writer, "403 Forbidden")
+            length = int(headers.get("content-length", 0))
+            if length > self.max_body:
+                return await self._respond(writer, "413 Payload Too Large")
+
+            try:
+                data = json.loads(await reader.readexactly(length))
+                if not isinstance(data, dict):
+                    raise ValueError(f"ожидался JSON-объект, получен {type(data).__name__}")
+                update = Update.de_json(data, self.app.bot)
+            except (ValueError, TypeError, KeyError, AttributeError) as e:
+                logging.warning(f"Некорректное обновление во вебхуке: {e}")
+                return await self._respond(writer, "400 Bad Request")
+            await self.app.update_queue.put(update)
+            await self._respond(writer, "200 OK")
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError) as e:
+            logging.warning(f"Ошибка запроса к вебхуку: {e}")
+        finally:
+            writer.close()
+
+async def wait_for_stop_signal():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # В Windows обработчиков сигналов в цикле нет: Ctrl+C прерывает ожидание через KeyboardInterrupt
+            pass
+    await stop.wait()
+
+async def run_webhook(app):
+    """Запускает приложение без long polling: обновления приходят на WebhookServer.
+
+    Если задан WEBHOOK_URL, вебхук регистрируется в Telegram; без него сервер
+    можно проверять локально, отправляя записанные обновления POST-запросами.
+    """
+    server = WebhookServer.from_env(app)
+    async with app:
+        await app.start()
+        await server.start()
+        public_url = os.getenv('WEBHOOK_URL')
+        if public_url:
+            await app.bot.set_webhook(
+                public_url.rstrip('/') + server.path,
+                secret_token=server.secret,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40)),
+            )
+        try:
+            await wait_for_stop_signal()
+        finally:
+            server.close()
+            await app.stop()
+
+def post_updates(path, url, secret=None):
+    """Отправляет записанные обновления (JSON по одному на строку) на локальный вебхук."""
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    with open(path, encoding="utf-8") as f, httpx.Client(timeout=10) as client:
+        for line in f:
+            if line.strip():
+                response = client.post(url, content=line.strip(), headers={**headers, "Content-Type": "application/json"})
+                print(response.status_code, line.strip()[:80])
+
+# Профили PRAGMA для SQLite, выбираются через DB_PRAGMA_PROFILE
+PRAGMA_PROFILES = {
+    # Поведение SQLite по умолчанию: rollback-журнал и полный fsync
+    "default": {},
+    # WAL с fsync только на чекпоинтах: устойчиво к падению процесса
+    "wal": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "temp_store": "MEMORY",
+    },
+    # Максимальная скорость записи ценой риска потерять последние транзакции при сбое ОС
+    "fast": {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "temp_store": "MEMORY",
+        "cache_size": -16000,
+    },
+}
+
 class DatabasePool:
+    """Пул соединений SQLite: одно соединение-писатель и N читателей.
+
+    Записи выстраиваются в очередь к писателю (FIFO-блокировка), чтение идёт
+    через read-only соединения, которым WAL позволяет не ждать писателя.
+    Внутри transaction() все запросы текущей задачи, включая чтение,
+    выполняются на соединении-писателе.
+    """
     _instance = None
     _lock = asyncio.Lock()
 
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, profile: str = "wal", readers: int = 4, cached_statements: int = 256):
         self.db_path = db_path
-        self.connection = None
+        self.profile = profile
+        # Читатели in-memory базы не увидят данных писателя
+        self.reader_count = 0 if db_path == ":memory:" else readers
+        self.cached_statements = cached_statements
+        self.writer = None
+        self.readers = []
+        self._idle_readers = asyncio.Queue()
+        self._write_lock = asyncio.Lock()
+        self._transaction = contextvars.ContextVar(f"db_transaction_{id(self)}", default=None)
+        self._stats = {
+            "reads": 0,
+            "writes": 0,
+            "read_wait_total": 0.0,
+            "read_wait_max": 0.0,
+            "write_wait_total": 0.0,
+            "write_wait_max": 0.0,
+            "write_queue": 0,
+        }
 
     @classmethod
     async def get_instance(cls, db_path="user_data.db"):
         async with cls._lock:
             if cls._instance is None:
-                cls._instance = cls(db_path)
+                cls._instance = cls(
+                    db_path,
+                    os.getenv('DB_PRAGMA_PROFILE', 'wal'),
+                    readers=int(os.getenv('DB_READERS', 4)),
+                    cached_statements=int(os.getenv('DB_CACHED_STATEMENTS', 256)),
+                )
                 await cls._instance.connect()
             return cls._instance
 
+    async def _open(self, read_only: bool):
+        if read_only:
+            connection = await aiosqlite.connect(
+                f"file:{self.db_path}?mode=ro", uri=True, cached_statements=self.cached_statements
+            )
+        else:
+            connection = await aiosqlite.connect(self.db_path, cached_statements=self.cached_statements)
+            await connection.execute("PRAGMA foreign_keys = ON;")  # Включить поддержку внешних ключей
+            for pragma, value in PRAGMA_PROFILES[self.profile].items():
+                await connection.execute(f"PRAGMA {pragma} = {value};")
+        await connection.execute("PRAGMA busy_timeout = 5000;")
+        return connection
+
     async def connect(self):
-        if self.connection is None:
-            self.connection = await aiosqlite.connect(self.db_path)
-            await self.connection.execute("PRAGMA foreign_keys = ON;")  # Включить поддержку внешних ключей
+        if self.writer is None:
+            # Писатель открывается первым: он создаёт файл и включает WAL
+            self.writer = await self._open(read_only=False)
+            for _ in range(self.reader_count):
+                reader = await self._open(read_only=True)
+                self.readers.append(reader)
+                self._idle_readers.put_nowait(reader)
 
     async def close(self):
-        if self.connection:
-            await self.connection.close()
-            self.connection = None
+        for reader in self.readers:
+            await reader.close()
+        self.readers = []
+        self._idle_readers = asyncio.Queue()
+        if self.writer:
+            await self.writer.close()
+            self.writer = None
+
+    def _record_wait(self, kind: str, started: float):
+        waited = time.perf_counter() - started
+        self._stats[f"{kind}_wait_total"] += waited
+        self._stats[f"{kind}_wait_max"] = max(self._stats[f"{kind}_wait_max"], waited)
+
+    @asynccontextmanager
+    async def _reader(self):
+        connection = self._transaction.get()
+        if connection is not None or not self.readers:
+            # Внутри транзакции читаем свои же незакоммиченные записи
+            async with self._writer() as connection:
+                yield connection
+            return
+        started = time.perf_counter()
+        connection = await self._idle_readers.get()
+        self._record_wait("read", started)
+        self._stats["reads"] += 1
+        try:
+            yield connection
+        finally:
+            self._idle_readers.put_nowait(connection)
+
+    @asynccontextmanager
+    async def _writer(self):
+        connection = self._transaction.get()
+        if connection is not None:
+            yield connection
+            return
+        started = time.perf_counter()
+        self._stats["write_queue"] += 1
+        try:
+            await self._write_lock.acquire()
+        finally:
+            self._stats["write_queue"] -= 1
+        self._record_wait("write", started)
+        self._stats["writes"] += 1
+        try:
+            yield self.writer
+        finally:
+            self._write_lock.release()
 
     async def execute(self, query: str, params=(), fetch: bool = False, fetchall: bool = False):
-        cursor = await self.connection.execute(query, params)
-        if fetch:
-            result = await cursor.fetchone()
-        elif fetchall:
-            result = await cursor.fetchall()
-        else:
-            result = None
-        await self.connection.commit()
-        await cursor.close()
-        return result
+        with DB_QUERY_SECONDS.time(statement=statement_label(query)):
+            return await self._execute(query, params, fetch, fetchall)
+
+    async def _execute(self, query: str, params, fetch: bool, fetchall: bool):
+        if fetch or fetchall:
+            async with self._reader() as connection:
+                async with connection.execute(query, params) as cursor:
+                    return await (cursor.fetchone() if fetch else cursor.fetchall())
+
+        async with self._writer() as connection:
+            async with connection.execute(query, params) as cursor:
+                rowcount = cursor.rowcount
+            if self._transaction.get() is None:
+                await connection.commit()
+            return rowcount
+
+    async def executemany(self, query: str, params_seq):
+        with DB_QUERY_SECONDS.time(statement=statement_label(query)):
+            async with self._writer() as connection:
+                await connection.executemany(query, params_seq)
+                if self._transaction.get() is None:
+                    await connection.commit()
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Объединяет все запросы внутри блока в одну транзакцию на писателе."""
+        if self._transaction.get() is not None:
+            # Вложенный блок становится частью внешней транзакции
+            yield self
+            return
+        async with self._writer() as connection:
+            token = self._transaction.set(connection)
+            try:
+                yield self
+                await connection.commit()
+            except BaseException:
+                await connection.rollback()
+                raise
+            finally:
+                self._transaction.reset(token)
+
+    def stats(self):
+        """Счётчики пула: занятость соединений и время ожидания."""
+        stats = dict(self._stats)
+        stats["readers_total"] = len(self.readers)
+        stats["readers_in_use"] = len(self.readers) - self._idle_readers.qsize()
+        stats["writer_in_use"] = self._write_lock.locked()
+        stats["read_wait_avg"] = stats["read_wait_total"] / stats["reads"] if stats["reads"] else 0.0
+        stats["write_wait_avg"] = stats["write_wait_total"] / stats["writes"] if stats["writes"] else 0.0
+        return stats
 
 # Define states for ConversationHandler
 (MAIN_MENU, FILTER_MENU, SET_MIN_PRICE, SET_MAX_PRICE, SET_ROOMS, 
- SET_METRO, SET_NEAR_METRO, RESET_MENU) = range(8)
+ SET_METRO, SET_NEAR_METRO, RESET_MENU, SET_CITY, SET_CATEGORY, SET_DIGEST) = range(11)
+
+# Города Kufar: slug -> (название для меню, значение gtsy)
+KUFAR_CITIES = {
+    'minsk': ("Минск", "country-belarus~province-minsk~locality-minsk"),
+    'brest': ("Брест", "country-belarus~province-brestskaja_oblast~locality-brest"),
+    'vitebsk': ("Витебск", "country-belarus~province-vitebskaja_oblast~locality-vitebsk"),
+    'gomel': ("Гомель", "country-belarus~province-gomelskaja_oblast~locality-gomel"),
+    'grodno': ("Гродно", "country-belarus~province-grodnenskaja_oblast~locality-grodno"),
+    'mogilev': ("Могилёв", "country-belarus~province-mogilevskaja_oblast~locality-mogilev"),
+}
+
+# Категории Kufar: slug -> (название для меню, параметры запроса)
+KUFAR_CATEGORIES = {
+    'kvartiru-dolgosrochno': ("Квартиры на длительный срок", {"cat": 1010, "rnt": 1}),
+    'kvartiru-posutochno': ("Квартиры посуточно", {"cat": 1010, "rnt": 2}),
+    'komnatu-dolgosrochno': ("Комнаты на длительный срок", {"cat": 1040, "rnt": 1}),
+}
+
+# Тип продавца: 'bez-posrednikov' оставляет только частные объявления
+KUFAR_FILTER_TYPES = {
+    'vse': {},
+    'bez-posrednikov': {"cmp": 0},
+}
+
+DEFAULT_CITY = 'minsk'
+DEFAULT_CATEGORY = 'kvartiru-dolgosrochno'
+DEFAULT_FILTER_TYPE = os.getenv('KUFAR_FILTER_TYPE', 'vse')
 
 async def init_db():
     db_pool = await DatabasePool.get_instance()  # Получаем экземпляр пула базы данных
@@ -81,146 +575,2159 @@ async def init_db():
             max_price INTEGER,
             rooms INTEGER,
             metro TEXT,
-            near_metro BOOLEAN
+            near_metro BOOLEAN,
+            city TEXT,
+            category TEXT,
+            digest_interval INTEGER
         )
     """)
+    await add_missing_columns(db_pool, "user_filters",
+                              {"city": "TEXT", "category": "TEXT", "digest_interval": "INTEGER"})
     await db_pool.execute("""
-        CREATE TABLE IF NOT EXISTS user_listings (
-            user_id INTEGER,
+        CREATE TABLE IF NOT EXISTS listings (
+            ad_id TEXT PRIMARY KEY,
             title TEXT,
             price TEXT,
             metro TEXT,
             link TEXT,
-            ad_id TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (user_id, link)
+            first_seen DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await db_pool.execute("""
+        CREATE TABLE IF NOT EXISTS deliveries (
+            user_id INTEGER NOT NULL,
+            ad_id TEXT NOT NULL,
+            ts DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, ad_id)
+        ) WITHOUT ROWID
+    """)
+    await db_pool.execute("CREATE INDEX IF NOT EXISTS idx_deliveries_ts ON deliveries (ts)")
+    await db_pool.execute("CREATE INDEX IF NOT EXISTS idx_deliveries_ad_id ON deliveries (ad_id)")
+    await db_pool.execute("CREATE INDEX IF NOT EXISTS idx_listings_first_seen ON listings (first_seen)")
+
+    # Пакеты новых объявлений от ведущего процесса для шардированных воркеров
+    await db_pool.execute("""
+        CREATE TABLE IF NOT EXISTS listing_batches (
+            batch_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            city TEXT NOT NULL,
+            category TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await db_pool.execute("""
+        CREATE TABLE IF NOT EXISTS batch_listings (
+            batch_id INTEGER NOT NULL REFERENCES listing_batches (batch_id) ON DELETE CASCADE,
+            ad_id TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            PRIMARY KEY (batch_id, ad_id)
+        ) WITHOUT ROWID
+    """)
+    await db_pool.execute("CREATE INDEX IF NOT EXISTS idx_listing_batches_created_at ON listing_batches (created_at)")
+    await db_pool.execute("""
+        CREATE TABLE IF NOT EXISTS shard_progress (
+            shard INTEGER NOT NULL,
+            shards INTEGER NOT NULL,
+            last_batch_id INTEGER NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (shard, shards)
+        )
+    """)
+
+    # Объявления, ожидающие отправки дайджестом; доставки по ним уже записаны
+    await db_pool.execute("""
+        CREATE TABLE IF NOT EXISTS pending_digests (
+            user_id INTEGER NOT NULL,
+            ad_id TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            queued_at REAL NOT NULL,
+            PRIMARY KEY (user_id, ad_id)
+        ) WITHOUT ROWID
+    """)
+
+    # Состояния диалогов и user_data для SQLitePersistence
+    await db_pool.execute("""
+        CREATE TABLE IF NOT EXISTS persistence (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (kind, key)
+        ) WITHOUT ROWID
+    """)
+
+    await migrate_user_listings(db_pool)
+
+    await db_pool.execute("""
+        CREATE TABLE IF NOT EXISTS crawl_watermarks (
+            query_key TEXT PRIMARY KEY,
+            last_ad_id TEXT,
+            last_list_time TEXT,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     """)
 
     logging.info("Database initialized.")
     
+async def add_missing_columns(db_pool, table, columns):
+    """Добавляет в существующую таблицу колонки, появившиеся в новых версиях схемы."""
+    existing = {row[1] for row in await db_pool.execute(f"PRAGMA table_info({table})", fetchall=True)}
+    for name, column_type in columns.items():
+        if name not in existing:
+            await db_pool.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+
+async def migrate_user_listings(db_pool):
+    """Переносит данные из старой таблицы user_listings (полная копия
+    объявления на каждого пользователя) в listings + deliveries.
+    """
+    legacy = await db_pool.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_listings'", fetch=True
+    )
+    if not legacy:
+        return
+
+    async with db_pool.transaction():
+        await db_pool.execute("""
+            INSERT OR IGNORE INTO listings (ad_id, title, price, metro, link, first_seen)
+            SELECT ad_id, title, price, metro, link, MIN(timestamp)
+            FROM user_listings
+            WHERE ad_id IS NOT NULL
+            GROUP BY ad_id
+        """)
+        await db_pool.execute("""
+            INSERT OR IGNORE INTO deliveries (user_id, ad_id, ts)
+            SELECT user_id, ad_id, timestamp
+            FROM user_listings
+            WHERE user_id IS NOT NULL AND ad_id IS NOT NULL
+        """)
+        await db_pool.execute("DROP TABLE user_listings")
+    logging.info("Таблица user_listings перенесена в listings/deliveries.")
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Привет! Используй меню для навигации.")
     return await show_main_menu(update, context)
 
 def format_price(price):
+    """Форматирует цену в копейках (int или строка цифр) как '1 234,56'."""
     try:
-        price_number = int(''.join(filter(str.isdigit, price)))
+        price_number = price if isinstance(price, int) else int(''.join(filter(str.isdigit, price)))
         rubles = price_number // 100
         kopecks = price_number % 100
-        return f"{rubles:,},{kopecks:02}".replace(',', ' ').replace('.', ',')
-    except ValueError:
-        return price
+        return f"{rubles:,}".replace(',', ' ') + f",{kopecks:02}"
+    except (TypeError, ValueError):
+        return price if price is not None else 'Не указана'
 
 async def execute_query(query, params=(), fetch=False, fetchall=False):
     db_pool = await DatabasePool.get_instance()
     return await db_pool.execute(query, params, fetch=fetch, fetchall=fetchall)
 
         
-def filter_listings(listings, **criteria):
-    def matches_criteria(listing):
+ROOMS_RE = re.compile(r'(\d+)\s*-?\s*(?:х\s*)?-?\s*комн', re.IGNORECASE)
+ROOMS_WORDS = {'одно': 1, 'двух': 2, 'трех': 3, 'четырех': 4, 'пяти': 5}
+ROOMS_WORDS_RE = re.compile(r'(одно|двух|трех|четырех|пяти)\s*-?\s*комн', re.IGNORECASE)
+
+def parse_price_kopecks(price):
+    digits = ''.join(filter(str.isdigit, str(price)))
+    return int(digits) if digits else None
+
+def parse_rooms(title):
+    title = (title or '').replace('ё', 'е')
+    match = ROOMS_RE.search(title)
+    if match:
+        return int(match.group(1))
+    match = ROOMS_WORDS_RE.search(title)
+    return ROOMS_WORDS[match.group(1).lower()] if match else None
+
+def normalize_metro(name):
+    return ' '.join((name or '').lower().replace('ё', 'е').split())
+
+# Станции минского метро: (название, широта, долгота); идентификатор станции — индекс в кортеже.
+# Координаты приблизительные, с точностью до входа, этого достаточно для фильтра близости
+MINSK_METRO_STATIONS = (
+    # Московская линия
+    ("Малиновка", 53.8497, 27.4749),
+    ("Петровщина", 53.8643, 27.4857),
+    ("Михалово", 53.8768, 27.4970),
+    ("Грушевка", 53.8867, 27.5147),
+    ("Институт культуры", 53.8855, 27.5386),
+    ("Площадь Ленина", 53.8937, 27.5478),
+    ("Октябрьская", 53.9016, 27.5618),
+    ("Площадь Победы", 53.9084, 27.5751),
+    ("Площадь Якуба Коласа", 53.9154, 27.5833),
+    ("Академия наук", 53.9219, 27.5994),
+    ("Парк Челюскинцев", 53.9240, 27.6138),
+    ("Московская", 53.9279, 27.6278),
+    ("Восток", 53.9344, 27.6513),
+    ("Борисовский тракт", 53.9385, 27.6659),
+    ("Уручье", 53.9453, 27.6877),
+    # Автозаводская линия
+    ("Каменная горка", 53.9068, 27.4377),
+    ("Кунцевщина", 53.9063, 27.4540),
+    ("Спортивная", 53.9086, 27.4805),
+    ("Пушкинская", 53.9094, 27.4957),
+    ("Молодёжная", 53.9065, 27.5220),
+    ("Фрунзенская", 53.9053, 27.5393),
+    ("Немига", 53.9052, 27.5541),
+    ("Купаловская", 53.9017, 27.5610),
+    ("Первомайская", 53.8937, 27.5702),
+    ("Пролетарская", 53.8893, 27.5854),
+    ("Тракторный завод", 53.8897, 27.6153),
+    ("Партизанская", 53.8759, 27.6290),
+    ("Автозаводская", 53.8690, 27.6478),
+    ("Могилёвская", 53.8617, 27.6744),
+    # Зеленолужская линия
+    ("Юбилейная площадь", 53.9045, 27.5380),
+    ("Площадь Франтишка Богушевича", 53.8963, 27.5386),
+    ("Вокзальная", 53.8895, 27.5468),
+    ("Ковальская Слобода", 53.8775, 27.5490),
+    ("Аэродромная", 53.8675, 27.5530),
+    ("Неморшанский сад", 53.8560, 27.5590),
+    ("Слуцкий гостинец", 53.8470, 27.5660),
+)
+
+# Радиус "рядом с метро" в метрах
+NEAR_METRO_RADIUS = int(os.getenv('NEAR_METRO_RADIUS', 1000))
+
+def normalize_station(name):
+    """Ключ для поиска станции: без регистра, ё, знаков препинания и сокращения "пл." """
+    key = re.sub(r'[^\w ]+', ' ', normalize_metro(name))
+    key = ' '.join(key.split())
+    return re.sub(r'^пл\b', 'площадь', key)
+
+def build_station_lookup(stations):
+    """Точные ключи поиска: полное название и название без слова "площадь"."""
+    lookup = {}
+    for station_id, (name, _, _) in enumerate(stations):
+        key = normalize_station(name)
+        lookup[key] = station_id
+        lookup.setdefault(key.replace('площадь ', ''), station_id)
+    return lookup
+
+STATION_LOOKUP = build_station_lookup(MINSK_METRO_STATIONS)
+
+@lru_cache(maxsize=4096)
+def resolve_station(name):
+    """Идентификатор станции по названию, в том числе с опечатками; None, если не похоже ни на одну."""
+    key = normalize_station(name)
+    if not key:
+        return None
+    if key in STATION_LOOKUP:
+        return STATION_LOOKUP[key]
+    match = difflib.get_close_matches(key, STATION_LOOKUP, n=1, cutoff=0.75)
+    return STATION_LOOKUP[match[0]] if match else None
+
+def metro_key(name):
+    """Ключ сравнения метро: id станции или нормализованный текст для неизвестных названий."""
+    station_id = resolve_station(name)
+    return station_id if station_id is not None else normalize_metro(name)
+
+class StationGrid:
+    """Равномерная сетка над станциями для поиска ближайшей.
+
+    Координаты переводятся в метры равнопромежуточной проекцией около
+    центра города; поиск обходит кольца ячеек, пока следующее кольцо
+    не может оказаться ближе уже найденной станции.
+    """
+
+    def __init__(self, stations, cell: float = 1000):
+        self.cell = cell
+        self.lat0 = sum(lat for _, lat, _ in stations) / len(stations)
+        self.cells = {}
+        self.points = []
+        for station_id, (_, lat, lon) in enumerate(stations):
+            x, y = self._project(lat, lon)
+            self.points.append((x, y))
+            self.cells.setdefault(self._cell(x, y), []).append(station_id)
+
+    def _project(self, lat, lon):
+        return lon * 111320 * math.cos(math.radians(self.lat0)), lat * 110540
+
+    def _cell(self, x, y):
+        return int(x // self.cell), int(y // self.cell)
+
+    def nearest(self, lat, lon, max_distance: float = 5000):
+        """(id станции, расстояние в метрах) или (None, None), если ближе max_distance станций нет."""
+        x, y = self._project(lat, lon)
+        cx, cy = self._cell(x, y)
+        best, best_distance = None, max_distance
+        for ring in range(int(max_distance // self.cell) + 2):
+            if best is not None and best_distance <= (ring - 1) * self.cell:
+                break
+            for dx in range(-ring, ring + 1):
+                for dy in range(-ring, ring + 1):
+                    if max(abs(dx), abs(dy)) != ring:
+                        continue
+                    for station_id in self.cells.get((cx + dx, cy + dy), ()):
+                        sx, sy = self.points[station_id]
+                        distance = math.hypot(sx - x, sy - y)
+                        if distance <= best_distance:
+                            best, best_distance = station_id, distance
+        return (best, round(best_distance)) if best is not None else (None, None)
+
+STATION_GRID = StationGrid(MINSK_METRO_STATIONS)
+
+def ad_parameters(ad):
+    return {param.get('p'): param for param in ad.get('ad_parameters', []) if isinstance(param, dict)}
+
+@dataclass(frozen=True, slots=True)
+class Listing:
+    """Объявление, разобранное один раз при загрузке.
+
+    Цена хранится в копейках, метро в двух видах: для показа и ключи
+    для сравнения (id станций, для неизвестных названий — нормализованный
+    текст). Ближайшая станция и расстояние до неё считаются по координатам.
+    """
+    ad_id: str
+    title: str
+    price: int | None
+    rooms: int | None
+    metro: str
+    metro_keys: frozenset
+    link: str
+    list_time: str | None = None
+    lat: float | None = None
+    lon: float | None = None
+    station_id: int | None = None
+    station_distance: int | None = None
+
+    @property
+    def near_metro(self):
+        if self.station_distance is not None:
+            return self.station_distance <= NEAR_METRO_RADIUS
+        # Без координат доверяем станции, указанной в объявлении
+        return any(isinstance(key, int) for key in self.metro_keys)
+
+    @classmethod
+    def from_ad(cls, ad):
+        params = ad_parameters(ad)
+        title = ad.get('subject', 'Нет заголовка')
+
+        metro = ad.get('location', {}).get('metro') or params.get('metro', {}).get('vl') or ''
+        names = metro if isinstance(metro, (list, tuple)) else str(metro).split(',')
+        names = [name.strip() for name in names if name and name.strip()]
+
         try:
-            price = int(''.join(filter(str.isdigit, listing.get('price', '0'))))
-            if criteria.get('min_price') and price < criteria['min_price'] * 100:
-                return False
-            if criteria.get('max_price') and price > criteria['max_price'] * 100:
-                return False
-            if criteria.get('rooms') and str(criteria['rooms']) not in listing.get('title', ''):
-                return False
-            if criteria.get('metro') and criteria['metro'].lower() not in listing.get('metro', '').lower():
+            rooms = int(params.get('rooms', {}).get('v'))
+        except (TypeError, ValueError):
+            rooms = parse_rooms(title)
+
+        lat = lon = None
+        coordinates = params.get('coordinates', {}).get('v')
+        if isinstance(coordinates, (list, tuple)) and len(coordinates) == 2:
+            try:
+                lon, lat = (float(value) for value in coordinates)
+            except (TypeError, ValueError):
+                lat = lon = None
+
+        metro_keys = {metro_key(name) for name in names}
+        station_id, station_distance = STATION_GRID.nearest(lat, lon) if lat is not None else (None, None)
+        if not names and station_id is not None and station_distance <= NEAR_METRO_RADIUS:
+            # Метро не указано, но станция рядом: показываем и фильтруем по ней
+            names = [f"{MINSK_METRO_STATIONS[station_id][0]} (~{station_distance} м)"]
+            metro_keys.add(station_id)
+
+        return cls(
+            ad_id=str(ad.get('ad_id', 'Нет ID')),
+            title=title,
+            price=parse_price_kopecks(ad.get('price_byn', '0')),
+            rooms=rooms,
+            metro=', '.join(names) if names else 'Метро не указано',
+            metro_keys=frozenset(metro_keys),
+            link=ad.get('ad_link', 'Ссылка отсутствует'),
+            list_time=ad.get('list_time'),
+            lat=lat,
+            lon=lon,
+            station_id=station_id,
+            station_distance=station_distance,
+        )
+
+    def to_payload(self):
+        return json.dumps([getattr(self, field.name) if field.name != 'metro_keys' else sorted(self.metro_keys, key=str)
+                           for field in fields(self)], ensure_ascii=False)
+
+    @classmethod
+    def from_payload(cls, payload):
+        values = dict(zip((field.name for field in fields(cls)), json.loads(payload)))
+        values['metro_keys'] = frozenset(values['metro_keys'])
+        return cls(**values)
+
+class IntervalTree:
+    """Статическое центрированное дерево интервалов.
+
+    Запрос точки возвращает все интервалы [lo, hi], содержащие её,
+    за O(log n + k). Пустые интервалы (lo > hi) не содержат ни одной точки
+    и отбрасываются: на них построение дерева не сходилось бы.
+    """
+
+    def __init__(self, intervals):
+        self.root = self._build([interval for interval in intervals if interval[0] <= interval[1]])
+
+    def _build(self, intervals):
+        if not intervals:
+            return None
+        points = sorted(point for lo, hi, _ in intervals for point in (lo, hi))
+        center = points[len(points) // 2]
+        left, right, here = [], [], []
+        for interval in intervals:
+            if interval[1] < center:
+                left.append(interval)
+            elif interval[0] > center:
+                right.append(interval)
+            else:
+                here.append(interval)
+        by_lo = sorted(here, key=lambda i: i[0])
+        by_hi = sorted(here, key=lambda i: i[1], reverse=True)
+        return (center, by_lo, by_hi, self._build(left), self._build(right))
+
+    def stab(self, point):
+        result = []
+        node = self.root
+        while node is not None:
+            center, by_lo, by_hi, left, right = node
+            if point < center:
+                for lo, _, value in by_lo:
+                    if lo > point:
+                        break
+                    result.append(value)
+                node = left
+            elif point > center:
+                for _, hi, value in by_hi:
+                    if hi < point:
+                        break
+                    result.append(value)
+                node = right
+            else:
+                result.extend(value for _, _, value in by_lo)
+                break
+        return result
+
+@dataclass(frozen=True, slots=True)
+class UserFilter:
+    min_price: int | None = None
+    max_price: int | None = None
+    rooms: int | None = None
+    metro: str | None = None
+    near_metro: bool | None = None
+    city: str | None = None
+    category: str | None = None
+    # None — сообщение на каждое объявление, 0 — дайджест за цикл, N — дайджест раз в N минут
+    digest_interval: int | None = None
+
+    @property
+    def query(self):
+        """Запрос к Kufar, который нужен этому подписчику."""
+        return (self.city or DEFAULT_CITY, self.category or DEFAULT_CATEGORY)
+
+    def is_empty(self):
+        return all(getattr(self, field.name) is None for field in fields(self))
+
+class FilterCache:
+    """Кэш фильтров и подписчиков в памяти процесса.
+
+    Загружается из базы одним запросом при старте; обработчики настроек
+    обновляют его сразу после записи в базу (write-through), поэтому циклу
+    проверки не нужны запросы к user_filters и subscribers.
+    """
+    _instance = None
+    _lock = asyncio.Lock()
+    # Воркер шарда держит в памяти только своих подписчиков: (shard, shards)
+    shard = None
+
+    def __init__(self):
+        self.filters = {}
+        self.subscribers = set()
+        self.version = 0
+        self._indexes = {}
+        self._index_version = -1
+
+    @classmethod
+    async def get_instance(cls):
+        async with cls._lock:
+            if cls._instance is None:
+                # Недогруженный кэш не публикуем: при ошибке следующий вызов загрузит заново
+                instance = cls()
+                await instance.load()
+                cls._instance = instance
+            return cls._instance
+
+    async def load(self):
+        where, params = "", ()
+        if self.shard is not None:
+            shard, shards = self.shard
+            where, params = " WHERE abs({column}) % ? = ?", (shards, shard)
+        # Фильтры и подписчики читаются одним запросом: строки подписчиков помечены is_subscriber = 1
+        rows = await execute_query(
+            "SELECT 0, user_id, min_price, max_price, rooms, metro, near_metro, city, category, digest_interval"
+            " FROM user_filters" + where.format(column="user_id")
+            + " UNION ALL SELECT 1, chat_id, NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL"
+            " FROM subscribers" + where.format(column="chat_id"),
+            params * 2, fetchall=True,
+        )
+        self.filters = {}
+        self.subscribers = set()
+        for is_subscriber, user_id, min_price, max_price, rooms, metro, near_metro, city, category, digest_interval in rows:
+            if is_subscriber:
+                self.subscribers.add(user_id)
+            else:
+                self.filters[user_id] = UserFilter(
+                    min_price, max_price, rooms, metro, None if near_metro is None else bool(near_metro),
+                    city, category, digest_interval,
+                )
+        self.version += 1
+        logging.info(f"Кэш фильтров загружен: {len(self.filters)} фильтров, {len(self.subscribers)} подписчиков.")
+
+    def get(self, user_id):
+        return self.filters.get(user_id)
+
+    def update(self, user_id, **values):
+        current = self.filters.get(user_id, UserFilter())
+        self.filters[user_id] = replace(current, **values)
+        self.version += 1
+
+    def clear(self, user_id, *names):
+        # Как и UPDATE в базе, сброс не создаёт запись для пользователя без фильтров
+        if user_id in self.filters:
+            self.update(user_id, **{name: None for name in names})
+
+    def remove(self, user_id):
+        if self.filters.pop(user_id, None) is not None:
+            self.version += 1
+
+    def subscribe(self, chat_id):
+        self.subscribers.add(chat_id)
+        self.version += 1
+
+    def unsubscribe(self, chat_id):
+        self.subscribers.discard(chat_id)
+        self.version += 1
+
+    def _rebuild(self):
+        """Индексы подписок по запросам, перестраиваются только после изменений кэша."""
+        if self._index_version == self.version:
+            return
+        empty = UserFilter()
+        rows_by_query = {}
+        for user_id in self.subscribers:
+            f = self.filters.get(user_id, empty)
+            rows_by_query.setdefault(f.query, []).append(
+                (user_id, f.min_price, f.max_price, f.rooms, f.metro, f.near_metro)
+            )
+        self._indexes = {query: SubscriptionIndex(rows) for query, rows in rows_by_query.items()}
+        self._index_version = self.version
+
+    def queries(self):
+        """Уникальные пары (город, категория), на которые есть подписчики."""
+        self._rebuild()
+        return list(self._indexes)
+
+    def index(self, query=(DEFAULT_CITY, DEFAULT_CATEGORY)):
+        self._rebuild()
+        return self._indexes.get(query) or SubscriptionIndex([])
+
+class SQLitePersistence(BasePersistence):
+    """Хранение состояний ConversationHandler и user_data в user_data.db.
+
+    Всё читается одним запросом при старте и дальше отдаётся из памяти.
+    Application передаёт изменения раз в update_interval секунд; они
+    копятся и записываются одной транзакцией после короткой паузы
+    (debounce), а при остановке — сразу через flush.
+    """
+
+    def __init__(self, update_interval: float, debounce: float):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.debounce = debounce
+        self.user_data = None
+        self.conversations = None
+        self._pending = {}
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+
+    async def _load(self):
+        if self.user_data is not None:
+            return
+        rows = await execute_query("SELECT kind, key, value FROM persistence", fetchall=True)
+        self.user_data, self.conversations = {}, {}
+        for kind, key, value in rows:
+            if kind == "user_data":
+                self.user_data[int(key)] = json.loads(value)
+            elif kind.startswith("conversation:"):
+                self.conversations.setdefault(kind.split(":", 1)[1], {})[tuple(json.loads(key))] = json.loads(value)
+        logging.info(f"Состояние бота загружено: {len(self.user_data)} user_data, "
+                     f"{sum(map(len, self.conversations.values()))} диалогов.")
+
+    def _write(self, kind, key, value):
+        # Последнее значение по ключу побеждает; None означает удаление строки
+        self._pending[(kind, key)] = None if value is None else json.dumps(value, ensure_ascii=False, default=str)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.debounce)
+        # Отмена из flush не должна прервать начатую запись
+        await asyncio.shield(self._flush_pending())
+
+    async def _flush_pending(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            try:
+                db_pool = await DatabasePool.get_instance()
+                await self._store(db_pool, pending)
+            except Exception as e:
+                # Возвращаем изменения в очередь; пришедшие за время записи новее и важнее
+                self._pending = {**pending, **self._pending}
+                logging.error(f"Не удалось записать состояние бота ({len(pending)} изменений): {e}")
+                return
+        logging.debug(f"Записано изменений состояния: {len(pending)}.")
+
+    async def _store(self, db_pool, pending):
+        async with db_pool.transaction():
+            await db_pool.executemany(
+                "INSERT INTO persistence (kind, key, value) VALUES (?, ?, ?)"
+                " ON CONFLICT(kind, key) DO UPDATE SET value=excluded.value",
+                [(kind, key, value) for (kind, key), value in pending.items() if value is not None],
+            )
+            await db_pool.executemany(
+                "DELETE FROM persistence WHERE kind = ? AND key = ?",
+                [(kind, key) for (kind, key), value in pending.items() if value is None],
+            )
+
+    async def get_user_data(self):
+        await self._load()
+        return {user_id: dict(data) for user_id, data in self.user_data.items()}
+
+    async def get_conversations(self, name):
+        await self._load()
+        return dict(self.conversations.get(name, {}))
+
+    async def update_user_data(self, user_id, data):
+        if self.user_data.get(user_id) == data:
+            return
+        self.user_data[user_id] = dict(data)
+        self._write("user_data", str(user_id), data)
+
+    async def drop_user_data(self, user_id):
+        if self.user_data.pop(user_id, None) is not None:
+            self._write("user_data", str(user_id), None)
+
+    async def update_conversation(self, name, key, new_state):
+        conversations = self.conversations.setdefault(name, {})
+        if conversations.get(key) == new_state:
+            return
+        if new_state is None:
+            conversations.pop(key, None)
+        else:
+            conversations[key] = new_state
+        self._write(f"conversation:{name}", json.dumps(list(key)), new_state)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def flush(self):
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self._flush_pending()
+
+    # Данные чатов, бота и callback_data не хранятся (store_data выше)
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+class SubscriptionIndex:
+    """Обратный индекс подписок: по объявлению находит подходящих подписчиков.
+
+    Цены хранятся в дереве интервалов, комнаты и станции метро в хеш-таблицах;
+    подписчики без соответствующего фильтра лежат в отдельных множествах
+    "любое значение". Перебор идёт по самому узкому измерению, остальные
+    (и близость к метро) проверяются по записи пользователя.
+    """
+
+    def __init__(self, rows):
+        self.records = {}
+        price_intervals = []
+        self.price_any = set()
+        self.rooms_by_value = {}
+        self.rooms_any = set()
+        self.metro_by_name = {}
+        self.metro_any = set()
+
+        for user_id, min_price, max_price, rooms, metro, near_metro in rows:
+            lo = min_price * 100 if min_price else 0
+            hi = max_price * 100 if max_price else float('inf')
+            user_metro = metro_key(metro) if metro else None
+            self.records[user_id] = (lo, hi, rooms or None, user_metro, bool(near_metro))
+
+            if min_price or max_price:
+                price_intervals.append((lo, hi, user_id))
+            else:
+                self.price_any.add(user_id)
+            if rooms:
+                self.rooms_by_value.setdefault(rooms, set()).add(user_id)
+            else:
+                self.rooms_any.add(user_id)
+            if user_metro is not None:
+                self.metro_by_name.setdefault(user_metro, set()).add(user_id)
+            else:
+                self.metro_any.add(user_id)
+
+        self.price_tree = IntervalTree(price_intervals)
+
+    def __len__(self):
+        return len(self.records)
+
+    def _accepts(self, user_id, price, rooms, stations, near):
+        lo, hi, user_rooms, user_metro, user_near = self.records[user_id]
+        return (
+            lo <= price <= hi
+            and (user_rooms is None or user_rooms == rooms)
+            and (user_metro is None or user_metro in stations)
+            and (near or not user_near)
+        )
+
+    def match(self, listing):
+        price = listing.price
+        if price is None:
+            return []
+        rooms = listing.rooms
+        stations = listing.metro_keys
+
+        by_price = self.price_tree.stab(price)
+        by_rooms = self.rooms_by_value.get(rooms, ()) if rooms is not None else ()
+        by_metro = [self.metro_by_name[name] for name in stations if name in self.metro_by_name]
+        candidates = min(
+            (len(by_price) + len(self.price_any), chain(by_price, self.price_any)),
+            (len(by_rooms) + len(self.rooms_any), chain(by_rooms, self.rooms_any)),
+            (sum(map(len, by_metro)) + len(self.metro_any), chain(*by_metro, self.metro_any)),
+            key=lambda option: option[0],
+        )[1]
+        near = listing.near_metro
+        return [user_id for user_id in set(candidates) if self._accepts(user_id, price, rooms, stations, near)]
+
+    def route(self, listings):
+        """Группирует объявления по подписчикам: {user_id: [listing, ...]}."""
+        routed = {}
+        for listing in listings:
+            for user_id in self.match(listing):
+                routed.setdefault(user_id, []).append(listing)
+        return routed
+
+class ListingCache:
+    """Общий снимок объявлений на цикл проверки.
+
+    Один запрос к Kufar на каждый уникальный набор параметров в пределах TTL,
+    результат разделяется между всеми подписчиками.
+    """
+    _instance = None
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries = {}
+        self._locks = {}
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            # TTL меньше минимального интервала цикла, иначе следующий цикл повторно разберёт тот же снимок
+            cls._instance = cls(float(os.getenv('LISTINGS_CACHE_TTL', 10)))
+        return cls._instance
+
+    async def get(self, **query):
+        key = tuple(sorted(query.items()))
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        # Блокировка не даёт параллельным вызовам выполнить один и тот же запрос дважды
+        async with lock:
+            entry = self._entries.get(key)
+            now = asyncio.get_running_loop().time()
+            if entry and now - entry[0] < self.ttl:
+                return entry[1]
+            listings = await fetch_kufar_data_api(**query)
+            # Пустой результат (ошибка запроса) не кэшируем
+            if listings:
+                self._entries[key] = (now, listings)
+            return listings
+
+    def invalidate(self):
+        self._entries.clear()
+
+async def get_listings(city=DEFAULT_CITY, category=DEFAULT_CATEGORY):
+    return await ListingCache.get_instance().get(city=city, category=category, filter_type=DEFAULT_FILTER_TYPE)
+
+async def fetch_demand(queries):
+    """Параллельно загружает выдачу для каждого нужного (город, категория).
+
+    Число одновременных обходов ограничено KUFAR_CRAWL_WORKERS. Объявление,
+    попавшее в несколько выдач, представлено одним объектом Listing.
+    """
+    semaphore = asyncio.Semaphore(int(os.getenv('KUFAR_CRAWL_WORKERS', 4)))
+
+    async def fetch(query):
+        async with semaphore:
+            city, category = query
+            return await get_listings(city=city, category=category)
+
+    # Сбой одной выдачи не должен лишать уведомлений подписчиков остальных
+    results = await asyncio.gather(*(fetch(query) for query in queries), return_exceptions=True)
+    canonical = {}
+    by_query = {}
+    for query, listings in zip(queries, results):
+        if isinstance(listings, Exception):
+            logging.error(f"Не удалось загрузить выдачу {query}: {listings!r}")
+            listings = []
+        by_query[query] = [canonical.setdefault(listing.ad_id, listing) for listing in listings]
+    cycle_count("ads_unique", len(canonical))
+    return by_query
+
+UPSERT_LISTING_SQL = """
+    INSERT INTO listings (ad_id, title, price, metro, link)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(ad_id) DO UPDATE SET
+        title=excluded.title,
+        price=excluded.price,
+        metro=excluded.metro,
+        link=excluded.link
+"""
+
+INSERT_DELIVERY_SQL = """
+    INSERT OR IGNORE INTO deliveries (user_id, ad_id)
+    VALUES (?, ?)
+"""
+
+def listing_rows(listings):
+    return [(l.ad_id, l.title, '' if l.price is None else str(l.price), l.metro, l.link) for l in listings]
+
+def delivery_rows(user_id, listings):
+    return [(user_id, l.ad_id) for l in listings]
+
+async def save_deliveries(db_pool, new_by_user, crawl_states=None):
+    unique_listings = {}
+    rows = []
+    for user_id, new_listings in new_by_user.items():
+        for listing in new_listings:
+            unique_listings[listing.ad_id] = listing
+        rows.extend(delivery_rows(user_id, new_listings))
+
+    async with db_pool.transaction():
+        await db_pool.executemany(UPSERT_LISTING_SQL, listing_rows(unique_listings.values()))
+        await db_pool.executemany(INSERT_DELIVERY_SQL, rows)
+        if crawl_states:
+            await store_crawl_states(db_pool, crawl_states)
+    if crawl_states:
+        commit_crawl_states(crawl_states)
+    seen = await SeenIndex.get_instance()
+    for user_id, ad_id in rows:
+        seen.add(user_id, ad_id)
+    DELIVERIES.inc(len(rows))
+    cycle_count("deliveries", len(rows))
+    return len(rows)
+
+class SeenIndex:
+    """Фильтр Блума по доставленным парам (пользователь, объявление).
+
+    Отрицательный ответ точен, поэтому базу спрашиваем только о возможных
+    совпадениях. Строится из deliveries при первом обращении, пополняется
+    после записи доставок и перестраивается в фоне при переполнении или
+    после очистки старых доставок (удалить элемент из фильтра нельзя).
+    """
+    _instance = None
+    _lock = asyncio.Lock()
+
+    HASHES = 7
+    # 10 бит на элемент при 7 хешах дают около 1% ложных срабатываний
+    BITS_PER_ITEM = 10
+    MIN_BITS = 1 << 20
+    LOAD_BATCH = 50000
+
+    def __init__(self):
+        self.bits = bytearray()
+        self.size = 0
+        self.count = 0
+        self.capacity = 0
+        self._pending = None
+        self._rebuild_task = None
+
+    @classmethod
+    async def get_instance(cls):
+        async with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                await cls._instance.load()
+            return cls._instance
+
+    @staticmethod
+    def _positions(user_id, ad_id, size):
+        digest = hashlib.blake2b(f"{user_id}:{ad_id}".encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % size for i in range(SeenIndex.HASHES)]
+
+    @staticmethod
+    def _set(bits, size, user_id, ad_id):
+        for position in SeenIndex._positions(user_id, ad_id, size):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    async def load(self):
+        """Строит фильтр заново; до замены запросы обслуживает старый."""
+        self._pending = []
+        try:
+            where, params = "", ()
+            if FilterCache.shard is not None:
+                shard, shards = FilterCache.shard
+                where, params = " AND abs(user_id) % ? = ?", (shards, shard)
+            (total,) = await execute_query(f"SELECT COUNT(*) FROM deliveries WHERE 1{where}", params, fetch=True)
+            # Запас вдвое, чтобы до следующей перестройки фильтр успел пополниться
+            capacity = max(2 * total, self.MIN_BITS // self.BITS_PER_ITEM)
+            size = capacity * self.BITS_PER_ITEM
+            bits = bytearray((size + 7) // 8)
+
+            last = (-1 << 63, "")
+            while True:
+                rows = await execute_query(
+                    f"SELECT user_id, ad_id FROM deliveries WHERE (user_id, ad_id) > (?, ?){where}"
+                    " ORDER BY user_id, ad_id LIMIT ?",
+                    (*last, *params, self.LOAD_BATCH), fetchall=True,
+                )
+                for user_id, ad_id in rows:
+                    self._set(bits, size, user_id, str(ad_id))
+                if len(rows) < self.LOAD_BATCH:
+                    break
+                last = rows[-1]
+
+            # Доставки, записанные во время загрузки, переносим до замены без await
+            for user_id, ad_id in self._pending:
+                self._set(bits, size, user_id, ad_id)
+            self.bits, self.size, self.capacity = bits, size, capacity
+            self.count = total + len(self._pending)
+        finally:
+            self._pending = None
+        logging.info(f"Индекс доставок построен: {self.count} пар, {len(self.bits) // 1024} КБ.")
+
+    def add(self, user_id, ad_id):
+        ad_id = str(ad_id)
+        if self.size:
+            self._set(self.bits, self.size, user_id, ad_id)
+        if self._pending is not None:
+            self._pending.append((user_id, ad_id))
+        self.count += 1
+        if self.count > self.capacity:
+            self.rebuild()
+
+    def rebuild(self):
+        if self._pending is None and (self._rebuild_task is None or self._rebuild_task.done()):
+            self._rebuild_task = asyncio.create_task(self.load())
+
+    def might_contain(self, user_id, ad_id):
+        if not self.size:
+            return True
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(user_id, ad_id, self.size))
+
+async def find_new_listings(user_id, listings):
+    seen = await SeenIndex.get_instance()
+    candidates = [listing.ad_id for listing in listings if seen.might_contain(user_id, listing.ad_id)]
+    existing_ad_ids = set()
+    # Подтверждаем в базе только возможные совпадения фильтра
+    for start in range(0, len(candidates), 500):
+        chunk = candidates[start:start + 500]
+        rows = await execute_query(
+            f"SELECT ad_id FROM deliveries WHERE user_id = ? AND ad_id IN ({', '.join('?' * len(chunk))})",
+            (user_id, *chunk), fetchall=True,
+        )
+        existing_ad_ids.update(str(ad_id) for (ad_id,) in rows)
+    cycle_count("seen_confirmations", len(candidates))
+    return [listing for listing in listings if listing.ad_id not in existing_ad_ids]
+
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, не больше capacity подряд."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = self._refill()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.capacity and time.monotonic() >= self.blocked_until
+
+def retry_after_seconds(error):
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+
+class NotificationDispatcher:
+    """Очередь уведомлений с пулом воркеров.
+
+    Сообщения одного чата отправляются одним заданием по порядку, поэтому
+    медленный чат задерживает только себя. Частота ограничена общим и
+    почекатовыми token bucket по лимитам Telegram; RetryAfter соблюдается,
+    сетевые ошибки повторяются с экспоненциальной задержкой, а чаты,
+    заблокировавшие бота, удаляются из подписчиков.
+    """
+    _instance = None
+
+    def __init__(self, workers: int, global_rate: float, chat_rate: float, max_retries: int, queue_size: int):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.bot = None
+        self._tasks = []
+
+    @classmethod
+    def from_env(cls, **overrides):
+        settings = {
+            "workers": int(os.getenv('NOTIFY_WORKERS', 8)),
+            "global_rate": float(os.getenv('TELEGRAM_GLOBAL_RATE', 30)),
+            "chat_rate": float(os.getenv('TELEGRAM_CHAT_RATE', 1)),
+            "max_retries": int(os.getenv('NOTIFY_MAX_RETRIES', 5)),
+            "queue_size": int(os.getenv('NOTIFY_QUEUE_SIZE', 10000)),
+        }
+        return cls(**{**settings, **overrides})
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            cls._instance = cls.from_env()
+        return cls._instance
+
+    def start(self, bot):
+        self.bot = bot
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self, drain_timeout: float = 10):
+        if self._tasks:
+            try:
+                await asyncio.wait_for(self.queue.join(), drain_timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"В очереди уведомлений осталось {self.queue.qsize()} заданий.")
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._tasks = []
+
+    async def submit(self, chat_id, messages):
+        await self.queue.put((chat_id, list(messages)))
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Убираем простаивающие бакеты, чтобы словарь не рос вместе с числом подписчиков
+            if len(self.chat_buckets) > 4 * self.queue.maxsize:
+                self.chat_buckets = {key: b for key, b in self.chat_buckets.items() if not b.idle()}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, 1)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            chat_id, messages = await self.queue.get()
+            try:
+                for text in messages:
+                    if not await self._send(chat_id, text):
+                        break
+            except Exception as e:
+                logging.error(f"Ошибка отправки для пользователя {chat_id}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def _send(self, chat_id, text):
+        """Отправляет одно сообщение; False, если чат больше недоступен."""
+        chat_bucket = self._chat_bucket(chat_id)
+        for attempt in range(self.max_retries + 1):
+            await chat_bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                MESSAGES_SENT.inc()
+                return True
+            except RetryAfter as e:
+                TELEGRAM_ERRORS.inc(kind="retry_after")
+                delay = retry_after_seconds(e)
+                logging.warning(f"Telegram 429 для {chat_id}, пауза {delay} с.")
+                self.global_bucket.pause(delay)
+                chat_bucket.pause(delay)
+            except Forbidden as e:
+                TELEGRAM_ERRORS.inc(kind="forbidden")
+                await self._drop_chat(chat_id, e)
                 return False
-        except Exception as e:
-            logging.warning(f"Ошибка фильтрации: {e}, объявление: {listing}")
-            return False
+            except BadRequest as e:
+                TELEGRAM_ERRORS.inc(kind="bad_request")
+                if 'chat not found' in str(e).lower():
+                    await self._drop_chat(chat_id, e)
+                    return False
+                logging.error(f"Telegram отклонил сообщение для {chat_id}: {e}")
+                return True
+            except NetworkError as e:
+                TELEGRAM_ERRORS.inc(kind="network")
+                delay = min(2 ** attempt, 60)
+                logging.warning(f"Сетевая ошибка при отправке {chat_id}: {e}, повтор через {delay} с.")
+                await asyncio.sleep(delay)
+        logging.error(f"Не удалось отправить сообщение {chat_id} после {self.max_retries + 1} попыток.")
         return True
 
-    return [listing for listing in listings if matches_criteria(listing)]
+    async def _drop_chat(self, chat_id, error):
+        logging.info(f"Чат {chat_id} недоступен ({error}), подписка удалена.")
+        await execute_query("DELETE FROM subscribers WHERE chat_id = ?", (chat_id,))
+        (await FilterCache.get_instance()).unsubscribe(chat_id)
+
+def format_listing_message(listing):
+    return (
+        f"Новое объявление:\n"
+        f"Название: {listing.title}\n"
+        f"Цена: {format_price(listing.price)} BYN\n"
+        f"Метро: {listing.metro}\n"
+        f"Ссылка: {listing.link}\n"
+    )
+
+# Ограничение Telegram на длину текста одного сообщения
+TELEGRAM_MESSAGE_LIMIT = 4096
 
-async def fetch_and_send_listings(user_id, context):
-    listings = fetch_kufar_data_api(city='minsk')
-    if not listings:
-        logging.error("Failed to fetch listings.")
+def format_digest_entry(listing):
+    return (
+        f"{listing.title}\n"
+        f"Цена: {format_price(listing.price)} BYN, метро: {listing.metro}\n"
+        f"{listing.link}\n"
+    )
+
+def format_digest_messages(listings, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Упаковывает объявления в как можно меньше сообщений не длиннее limit."""
+    messages = []
+    current = ""
+    for listing in listings:
+        entry = format_digest_entry(listing)[:limit]
+        if current and len(current) + 1 + len(entry) > limit:
+            messages.append(current)
+            current = ""
+        current = f"{current}\n{entry}" if current else entry
+    if current:
+        messages.append(current)
+    if len(messages) > 1 or len(listings) > 1:
+        header = f"Новых объявлений: {len(listings)}\n\n"
+        if len(header) + len(messages[0]) <= limit:
+            messages[0] = header + messages[0]
+    return messages
+
+async def send_listings(user_id, listings, context):
+    user_filter = (await FilterCache.get_instance()).get(user_id)
+    digest_interval = user_filter.digest_interval if user_filter else None
+    if digest_interval:
+        # Отложенный дайджест: объявления ждут в базе до flush_digests
+        await queue_digest(user_id, listings)
         return
 
-    filters = await execute_query("SELECT min_price, max_price, rooms, metro FROM user_filters WHERE user_id = ?", (user_id,), fetch=True)
-    if filters:
-        min_price, max_price, rooms, metro = filters
-        listings = filter_listings(listings, min_price=min_price, max_price=max_price, rooms=rooms, metro=metro)
+    dispatcher = NotificationDispatcher.get_instance()
+    dispatcher.start(context.bot)
+    if digest_interval is None:
+        await dispatcher.submit(user_id, [format_listing_message(listing) for listing in listings])
+    else:
+        await dispatcher.submit(user_id, format_digest_messages(listings))
 
-    await check_and_save_listings(user_id, listings, context)
+class DigestQueue:
+    """Учёт отложенных дайджестов в памяти: user_id -> время первого объявления в очереди.
 
-async def check_and_save_listings(user_id, listings, context):
-    existing_ads = await execute_query("SELECT ad_id FROM user_listings WHERE user_id = ?", (user_id,), fetchall=True)
-    existing_ad_ids = {row[0] for row in existing_ads}
-    new_listings = [listing for listing in listings if listing['ad_id'] not in existing_ad_ids]
+    Сами объявления лежат в pending_digests; отсюда берётся только расписание,
+    поэтому цикл без созревших дайджестов не делает запросов к базе.
+    Загружается одним запросом при первом обращении.
+    """
+    _instance = None
+    _lock = asyncio.Lock()
 
-    if new_listings:
-        await execute_query("""
-            INSERT INTO user_listings (user_id, title, price, metro, link, ad_id)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, [(user_id, l['title'], l['price'], l['metro'], l['link'], l['ad_id']) for l in new_listings])
+    def __init__(self):
+        self.queued = {}
 
-        for listing in new_listings:
-            message = (
-                f"Новое объявление:\n"
-                f"Название: {listing['title']}\n"
-                f"Цена: {format_price(listing['price'])} BYN\n"
-                f"Метро: {listing['metro']}\n"
-                f"Ссылка: {listing['link']}\n"
+    @classmethod
+    async def get_instance(cls):
+        async with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                await cls._instance.load()
+            return cls._instance
+
+    async def load(self):
+        rows = await execute_query(
+            "SELECT user_id, MIN(queued_at) FROM pending_digests GROUP BY user_id", fetchall=True,
+        )
+        self.queued = dict(rows)
+
+    def add(self, user_id, queued_at):
+        self.queued.setdefault(user_id, queued_at)
+
+    def due(self, cache, now):
+        due = []
+        for user_id, first_queued in self.queued.items():
+            if cache.shard is not None and shard_of(user_id, cache.shard[1]) != cache.shard[0]:
+                continue
+            user_filter = cache.get(user_id)
+            interval = user_filter.digest_interval if user_filter else None
+            if not interval or now - first_queued >= interval * 60:
+                due.append(user_id)
+        return due
+
+    def pop(self, user_id):
+        self.queued.pop(user_id, None)
+
+async def queue_digest(user_id, listings):
+    queued_at = time.time()
+    db_pool = await DatabasePool.get_instance()
+    await db_pool.executemany("""
+        INSERT OR IGNORE INTO pending_digests (user_id, ad_id, payload, queued_at)
+        VALUES (?, ?, ?, ?)
+    """, [(user_id, listing.ad_id, listing.to_payload(), queued_at) for listing in listings])
+    (await DigestQueue.get_instance()).add(user_id, queued_at)
+    cycle_count("digest_queued", len(listings))
+
+async def flush_digests(context):
+    """Отправляет отложенные дайджесты, у которых истёк интервал пользователя.
+
+    Если пользователь отключил дайджест, накопленное уходит сразу. Воркер
+    шарда отправляет только дайджесты своих подписчиков.
+    """
+    cache = await FilterCache.get_instance()
+    queue = await DigestQueue.get_instance()
+    due = queue.due(cache, time.time())
+    if not due:
+        return 0
+
+    db_pool = await DatabasePool.get_instance()
+    dispatcher = NotificationDispatcher.get_instance()
+    dispatcher.start(context.bot)
+    for user_id in due:
+        # Снимаем с учёта до чтения: объявления, добавленные позже, попадут либо в эту выборку,
+        # либо в новую запись очереди
+        queue.pop(user_id)
+        async with db_pool.transaction():
+            rows = await db_pool.execute(
+                "SELECT payload FROM pending_digests WHERE user_id = ? ORDER BY queued_at", (user_id,), fetchall=True,
             )
-            await context.bot.send_message(chat_id=user_id, text=message)
-    else:
-        logging.info(f"No new listings for user {user_id}.")
+            await db_pool.execute("DELETE FROM pending_digests WHERE user_id = ?", (user_id,))
+        if rows and user_id in cache.subscribers:
+            await dispatcher.submit(user_id, format_digest_messages([Listing.from_payload(p) for (p,) in rows]))
+    cycle_count("digests_flushed", len(due))
+    logging.info(f"Отправлено отложенных дайджестов: {len(due)}.")
+    return len(due)
+
+async def save_and_send_batch(routed, context, deadline=None, crawl_states=None):
+    """Проверка и отправка для всего цикла:
+    новые объявления всех пользователей записываются одной транзакцией,
+    уведомления отправляются после коммита.
+
+    Если задан deadline (time.monotonic()), пользователи, до которых
+    не дошла очередь, возвращаются как {user_id: [listing, ...]} для
+    следующего цикла. Водяные знаки crawl_states записываются вместе с
+    доставками и только если обработаны все пользователи.
+    """
+    new_by_user = {}
+    leftover = {}
+    with stage("dedupe"):
+        processed = 0
+        for user_id, user_listings in routed.items():
+            # Хотя бы один пользователь обрабатывается всегда, чтобы перенос не копился бесконечно
+            if deadline is not None and processed and time.monotonic() > deadline:
+                leftover[user_id] = user_listings
+                continue
+            processed += 1
+            new_listings = await find_new_listings(user_id, user_listings)
+            if new_listings:
+                new_by_user[user_id] = new_listings
+    if leftover:
+        logging.warning(f"Бюджет цикла исчерпан, {len(leftover)} пользователей перенесено на следующий цикл.")
+        cycle_count("carried_users", len(leftover))
+        # Водяной знак не сдвигаем: после перезапуска перенесённые объявления будут загружены заново
+        crawl_states = None
 
-# Функция для получения данных через API Kufar
-def fetch_kufar_data_api(city='minsk', category='kvartiru-dolgosrochno', filter_type='bez-posrednikov'):
-    url = "https://api.kufar.by/search-api/v2/search/rendered-paginated"
-    params = {
-        "lang": "ru",
-        "size": 30,
-        "cat": 1010,
-        "cur": "BYR",
-        "gtsy": f"country-belarus~province-minsk~locality-{city}",
-        "rnt": 1,
-    }
-    headers = {
+    db_pool = await DatabasePool.get_instance()
+    if not new_by_user:
+        logging.info("Новых объявлений для подписчиков нет.")
+        if crawl_states:
+            with stage("persist"):
+                async with db_pool.transaction():
+                    await store_crawl_states(db_pool, crawl_states)
+                commit_crawl_states(crawl_states)
+        return leftover
+
+    with stage("persist"):
+        saved = await save_deliveries(db_pool, new_by_user, crawl_states)
+    logging.info(f"Сохранено {saved} доставок для {len(new_by_user)} пользователей.")
+
+    with stage("notify"):
+        for user_id, new_listings in new_by_user.items():
+            await send_listings(user_id, new_listings, context)
+    return leftover
+
+class KufarClient:
+    """Асинхронный HTTP-клиент Kufar с пулом keep-alive соединений.
+
+    Соединения переиспользуются между вызовами, число одновременных запросов
+    ограничено семафором, таймауты задаются через переменные окружения.
+    """
+    _instance = None
+
+    BASE_URL = "https://api.kufar.by"
+    HEADERS = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/130.0.0.0 Safari/537.36',
         'Referer': 'https://re.kufar.by/',
     }
+
+    def __init__(self, connect_timeout: float, read_timeout: float, max_concurrency: int, base_url: str = BASE_URL):
+        self.base_url = base_url
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.client = None
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            cls._instance = cls(
+                connect_timeout=float(os.getenv('KUFAR_CONNECT_TIMEOUT', 5)),
+                read_timeout=float(os.getenv('KUFAR_READ_TIMEOUT', 15)),
+                max_concurrency=int(os.getenv('KUFAR_MAX_CONCURRENCY', 4)),
+                base_url=os.getenv('KUFAR_BASE_URL', cls.BASE_URL),
+            )
+        return cls._instance
+
+    def connect(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers=self.HEADERS,
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency,
+                ),
+            )
+
+    async def close(self):
+        if self.client:
+            await self.client.aclose()
+            self.client = None
+
+    async def get(self, path: str, params=None, headers=None):
+        self.connect()
+        async with self._semaphore:
+            started = time.perf_counter()
+            status = "error"
+            try:
+                response = await self.client.get(path, params=params, headers=headers)
+                status = str(response.status_code)
+                if CAPTURE_LOG.handlers:
+                    capture_response(path, params, response)
+                return response
+            finally:
+                KUFAR_REQUEST_SECONDS.observe(time.perf_counter() - started)
+                KUFAR_REQUESTS.inc(status=status)
+
+# Запись ответов Kufar для последующего воспроизведения: JSON на строку,
+# файл ротируется по размеру. Включается переменной KUFAR_CAPTURE_PATH
+CAPTURE_LOG = logging.getLogger("kufar.capture")
+CAPTURE_LOG.propagate = False
+CAPTURE_HEADERS = ('ETag', 'Last-Modified', 'Content-Type')
+
+def start_capture(path=None):
+    path = path or os.getenv('KUFAR_CAPTURE_PATH')
+    if not path or CAPTURE_LOG.handlers:
+        return
+    handler = logging.handlers.RotatingFileHandler(
+        path,
+        maxBytes=int(os.getenv('KUFAR_CAPTURE_MAX_BYTES', 50 * 1024 * 1024)),
+        backupCount=int(os.getenv('KUFAR_CAPTURE_BACKUPS', 5)),
+        encoding='utf-8',
+    )
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    CAPTURE_LOG.addHandler(handler)
+    CAPTURE_LOG.setLevel(logging.INFO)
+    logging.info(f"Ответы Kufar записываются в {path}")
+
+def capture_response(path, params, response):
+    CAPTURE_LOG.info(json.dumps({
+        "ts": time.time(),
+        "path": path,
+        "params": params or {},
+        "status": response.status_code,
+        "headers": {name: response.headers[name] for name in CAPTURE_HEADERS if name in response.headers},
+        "body": response.text,
+    }, ensure_ascii=False))
+
+def capture_key(path, params):
+    return path, tuple(sorted((name, str(value)) for name, value in (params or {}).items()))
+
+class ReplayKufarClient(KufarClient):
+    """Подменяет сеть записанными ответами одного цикла.
+
+    Для каждого запроса отдаётся следующий записанный ответ с теми же
+    path и параметрами; если его нет, первая страница считается
+    неизменившейся (304), а остальные — отсутствующими (404).
+    """
+
+    def __init__(self):
+        super().__init__(connect_timeout=0, read_timeout=0, max_concurrency=1, base_url=self.BASE_URL)
+        self.responses = {}
+
+    def load_cycle(self, entries):
+        self.responses = {}
+        for entry in entries:
+            self.responses.setdefault(capture_key(entry["path"], entry["params"]), deque()).append(entry)
+
+    async def get(self, path: str, params=None, headers=None):
+        queue = self.responses.get(capture_key(path, params))
+        request = httpx.Request("GET", self.base_url + path, params=params)
+        if not queue:
+            return httpx.Response(404 if "cursor" in (params or {}) else 304, request=request)
+        entry = queue.popleft()
+        return httpx.Response(entry["status"], headers=entry["headers"], text=entry["body"], request=request)
+
+    async def close(self):
+        pass
+
+def read_capture(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def split_capture_cycles(entries):
+    """Делит запись на циклы: новый цикл начинается с повторного запроса первой страницы той же выдачи."""
+    cycle, first_pages = [], set()
+    for entry in entries:
+        if "cursor" not in entry["params"]:
+            key = capture_key(entry["path"], entry["params"])
+            if key in first_pages:
+                yield cycle
+                cycle, first_pages = [], set()
+            first_pages.add(key)
+        cycle.append(entry)
+    if cycle:
+        yield cycle
+
+class ReplayBot:
+    """Бот-заглушка для воспроизведения: ничего не отправляет, только считает."""
+
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, chat_id, text):
+        self.sent += 1
+
+async def replay_capture(path, db_path, speed: float = 0, reset_watermarks: bool = False):
+    """Прогоняет scheduled_check по записанным ответам Kufar вместо сети.
+
+    speed=1 воспроизводит паузы между циклами как при записи, speed=10 —
+    в десять раз быстрее, speed=0 — без пауз. Сообщения не отправляются:
+    бот-заглушка только считает их. Базу лучше брать копией рабочей.
+    """
+    db_pool = await DatabasePool.get_instance(db_path)
+    await init_db()
+    if reset_watermarks:
+        await db_pool.execute("DELETE FROM crawl_watermarks")
+    client = KufarClient._instance = ReplayKufarClient()
+    # Заглушке лимиты Telegram не нужны; для настройки пропускной способности их задают через окружение
+    NotificationDispatcher._instance = NotificationDispatcher.from_env(
+        global_rate=float(os.getenv('TELEGRAM_GLOBAL_RATE', 1e6)),
+        chat_rate=float(os.getenv('TELEGRAM_CHAT_RATE', 1e6)),
+    )
+    bot = ReplayBot()
+    context = SimpleNamespace(bot=bot)
+
+    cycles = []
+    previous_ts = None
     try:
-        response = requests.get(url, params=params, headers=headers)
-        response.raise_for_status()
-        data = response.json()
-        return [
-            {
-                'ad_id': ad.get('ad_id', 'Нет ID'),
-                'title': ad.get('subject', 'Нет заголовка'),
-                'price': ad.get('price_byn', '0'),
-                'metro': ad.get('location', {}).get('metro', 'Метро не указано'),
-                'link': ad.get('ad_link', 'Ссылка отсутствует'),
-            }
-            for ad in data.get('ads', [])
-        ]
-    except requests.RequestException as e:
+        for entries in split_capture_cycles(read_capture(path)):
+            ts = entries[0]["ts"]
+            if speed and previous_ts is not None:
+                await asyncio.sleep(max(0.0, ts - previous_ts) / speed)
+            previous_ts = ts
+            client.load_cycle(entries)
+            # Кэш выдачи рассчитан на реальное время и при ускорении отдал бы прошлый снимок
+            ListingCache.get_instance().invalidate()
+            cycle = await scheduled_check(context)
+            await NotificationDispatcher.get_instance().queue.join()
+            cycle["recorded_at"] = ts
+            cycles.append(cycle)
+            logging.info(f"Воспроизведён цикл {len(cycles)}: {cycle['outcome']}, {cycle['counts']}")
+    finally:
+        await NotificationDispatcher.get_instance().close()
+        await db_pool.close()
+    return {"cycles": len(cycles), "messages": bot.sent, "details": cycles}
+
+def next_page_cursor(data):
+    for page in data.get('pagination', {}).get('pages', []):
+        if page.get('label') == 'next':
+            return page.get('token')
+    return None
+
+@dataclass(slots=True)
+class CrawlState:
+    """Состояние обхода одного запроса, живущее между циклами.
+
+    Кроме водяного знака хранит валидаторы HTTP-кэша и отпечатки первой
+    страницы, чтобы неизменившаяся выдача стоила один HTTP-запрос.
+
+    Обход с новыми объявлениями не сдвигает состояние сразу, а оставляет
+    его в pending: водяной знак записывается в той же транзакции, что и
+    доставки (или пакеты для воркеров), и только тогда применяется в памяти.
+    """
+    last_ad_id: str | None = None
+    last_list_time: str | None = None
+    etag: str | None = None
+    last_modified: str | None = None
+    body_hash: bytes | None = None
+    ids_hash: bytes | None = None
+    pending: dict | None = None
+
+    def commit(self, values):
+        for name, value in values.items():
+            setattr(self, name, value)
+        # Более поздний обход мог успеть оставить своё состояние, его не трогаем
+        if self.pending is values:
+            self.pending = None
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+# Водяной знак читается из базы один раз на запрос, дальше живёт в памяти
+CRAWL_STATES = {}
+
+async def get_crawl_state(query_key):
+    state = CRAWL_STATES.get(query_key)
+    if state is None:
+        watermark = await load_watermark(query_key)
+        state = CRAWL_STATES[query_key] = CrawlState(*(watermark or (None, None)))
+    return state
+
+async def load_watermark(query_key):
+    return await execute_query(
+        "SELECT last_ad_id, last_list_time FROM crawl_watermarks WHERE query_key = ?",
+        (query_key,), fetch=True,
+    )
+
+UPSERT_WATERMARK_SQL = """
+    INSERT INTO crawl_watermarks (query_key, last_ad_id, last_list_time)
+    VALUES (?, ?, ?)
+    ON CONFLICT(query_key) DO UPDATE SET
+        last_ad_id=excluded.last_ad_id,
+        last_list_time=excluded.last_list_time,
+        updated_at=CURRENT_TIMESTAMP
+"""
+
+async def save_watermark(query_key, ad_id, list_time):
+    await execute_query(UPSERT_WATERMARK_SQL, (query_key, ad_id, list_time))
+    state = CRAWL_STATES.get(query_key)
+    if state is not None:
+        state.last_ad_id, state.last_list_time = ad_id, list_time
+
+def take_pending_crawl_states():
+    """Снимок состояний обходов, ожидающих записи: {query_key: (state, values)}."""
+    return {key: (state, state.pending) for key, state in CRAWL_STATES.items() if state.pending}
+
+async def store_crawl_states(db_pool, crawl_states):
+    """Пишет водяные знаки снимка; вызывается внутри открытой транзакции."""
+    await db_pool.executemany(UPSERT_WATERMARK_SQL, [
+        (key, values['last_ad_id'], values['last_list_time']) for key, (_, values) in crawl_states.items()
+    ])
+
+def commit_crawl_states(crawl_states):
+    for state, values in crawl_states.values():
+        state.commit(values)
+
+def fingerprint(data: bytes):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def is_before_watermark(listing, last_ad_id, last_list_time):
+    """Объявление не новее водяного знака: раньше по list_time или то же
+    самое объявление с тем же временем (ISO-строки сравниваются как строки)."""
+    if last_list_time and listing.list_time:
+        if listing.list_time != last_list_time:
+            return listing.list_time < last_list_time
+    return listing.ad_id == last_ad_id
+
+async def crawl_listings(params, query_key):
+    """Обходит страницы выдачи (от новых к старым), пока не дойдёт до
+    объявлений не новее сохранённого водяного знака.
+
+    Граница определяется по list_time: поднятое владельцем объявление
+    уходит наверх выдачи, поэтому совпадение ad_id само по себе не значит,
+    что ниже нет новых объявлений. ad_id используется только при равном
+    времени или если времени в выдаче нет.
+
+    Первая страница запрашивается условно (If-None-Match/If-Modified-Since);
+    если сервер ответил 304 или совпал хеш тела либо упорядоченного списка
+    ad_id, обход заканчивается сразу, без разбора объявлений и запросов к базе.
+
+    Новые объявления не сдвигают водяной знак сразу: он остаётся в
+    state.pending до записи доставок, чтобы после ошибки или перезапуска
+    следующий цикл повторил обход с прежней точки.
+    """
+    max_pages = int(os.getenv('KUFAR_MAX_PAGES', 10))
+    state = await get_crawl_state(query_key)
+    last_ad_id, last_list_time = state.last_ad_id, state.last_list_time
+
+    client = KufarClient.get_instance()
+    path = "/search-api/v2/search/rendered-paginated"
+    response = await client.get(path, params=params, headers=state.conditional_headers())
+    if response.status_code == 304:
+        logging.debug(f"Обход {query_key}: выдача не изменилась (304).")
+        return []
+    response.raise_for_status()
+    body_hash = fingerprint(response.content)
+    if body_hash == state.body_hash:
+        logging.debug(f"Обход {query_key}: выдача не изменилась (хеш тела).")
+        return []
+    data = response.json()
+    ids_hash = fingerprint("\n".join(str(ad.get('ad_id')) for ad in data.get('ads', [])).encode())
+    if ids_hash == state.ids_hash:
+        state.body_hash = body_hash
+        logging.debug(f"Обход {query_key}: выдача не изменилась (список ad_id).")
+        return []
+    first_response = response
+
+    listings = []
+    reached_watermark = False
+    for page in range(max_pages):
+        if page:
+            response = await client.get(path, params=dict(params, cursor=cursor))
+            response.raise_for_status()
+            data = response.json()
+
+        ads = data.get('ads', [])
+        ADS_FETCHED.inc(len(ads))
+        cycle_count("ads_fetched", len(ads))
+        for ad in ads:
+            listing = Listing.from_ad(ad)
+            if last_ad_id is not None and is_before_watermark(listing, last_ad_id, last_list_time):
+                reached_watermark = True
+                break
+            listings.append(listing)
+
+        cursor = next_page_cursor(data)
+        # Без водяного знака (первый запуск) достаточно первой страницы
+        if reached_watermark or not cursor or last_ad_id is None:
+            break
+
+    ADS_NEW.inc(len(listings))
+    cycle_count("ads_new", len(listings))
+    values = {
+        "etag": first_response.headers.get('ETag'),
+        "last_modified": first_response.headers.get('Last-Modified'),
+        "body_hash": body_hash,
+        "ids_hash": ids_hash,
+    }
+    if listings:
+        # Водяной знак — самое позднее list_time среди новых, а не первое объявление выдачи
+        newest = max(listings, key=lambda listing: listing.list_time or "")
+        state.pending = {**values, "last_ad_id": newest.ad_id, "last_list_time": newest.list_time}
+    else:
+        # Новых объявлений нет, терять нечего: отпечатки применяются сразу
+        state.commit(values)
+    logging.info(f"Обход {query_key}: {len(listings)} новых объявлений.")
+    return listings
+
+def search_params(city=DEFAULT_CITY, category=DEFAULT_CATEGORY, filter_type=None):
+    gtsy = KUFAR_CITIES[city][1] if city in KUFAR_CITIES else f"country-belarus~province-minsk~locality-{city}"
+    return {
+        "lang": "ru",
+        "size": int(os.getenv('KUFAR_PAGE_SIZE', 30)),
+        "cur": "BYR",
+        "gtsy": gtsy,
+        "sort": "lst.d",
+        **KUFAR_CATEGORIES[category][1],
+        **KUFAR_FILTER_TYPES.get(filter_type, {}),
+    }
+
+def search_query_key(params):
+    key = f"{params['cat']}:{params['gtsy']}:{params['rnt']}"
+    return f"{key}:cmp{params['cmp']}" if 'cmp' in params else key
+
+# Функция для получения данных через API Kufar
+async def fetch_kufar_data_api(city=DEFAULT_CITY, category=DEFAULT_CATEGORY, filter_type=DEFAULT_FILTER_TYPE):
+    params = search_params(city, category, filter_type)
+    try:
+        return await crawl_listings(params, search_query_key(params))
+    except httpx.HTTPError as e:
         logging.error(f"Ошибка при запросе: {e}")
         return []
+    except ValueError as e:
+        # Не-JSON ответ с кодом 200 (страница ограничения или капчи) не должен ронять весь цикл
+        logging.error(f"Некорректный ответ Kufar для {city}/{category}: {e}")
+        return []
 
 from telegram.ext import Application, CallbackContext
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-async def scheduled_check(context: ContextTypes.DEFAULT_TYPE):
-    logging.info("Запуск регулярной задачи 'scheduled_check'.")
+class RetentionJob:
+    """Фоновая очистка старых доставок и объявлений.
+
+    Удаляет строки небольшими пачками по индексам ts/first_seen, отпуская
+    писателя между пачками, чтобы не задерживать цикл уведомлений.
+    Освободившиеся страницы возвращаются через incremental_vacuum.
+    """
+    _instance = None
+
+    def __init__(self, retention_days: int, batch_size: int, vacuum_pages: int):
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.last_report = None
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            cls._instance = cls(
+                retention_days=int(os.getenv('RETENTION_DAYS', 30)),
+                batch_size=int(os.getenv('RETENTION_BATCH_SIZE', 5000)),
+                vacuum_pages=int(os.getenv('RETENTION_VACUUM_PAGES', 1000)),
+            )
+        return cls._instance
+
+    async def _purge(self, db_pool, query, cutoff):
+        total = 0
+        while True:
+            deleted = await db_pool.execute(query, (cutoff, self.batch_size))
+            total += deleted
+            if deleted < self.batch_size:
+                return total
+            # Даём обработчикам и циклу проверки доступ к писателю между пачками
+            await asyncio.sleep(0)
+
+    async def _vacuum(self, db_pool):
+        (free_pages,) = await db_pool.execute("PRAGMA freelist_count", fetch=True)
+        if not free_pages or free_pages < self.vacuum_pages:
+            return 0
+        (auto_vacuum,) = await db_pool.execute("PRAGMA auto_vacuum", fetch=True)
+        if auto_vacuum == 2:
+            await db_pool.execute(f"PRAGMA incremental_vacuum({free_pages})")
+        else:
+            # Однократный полный VACUUM переводит базу в режим incremental
+            await db_pool.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            await db_pool.execute("VACUUM")
+        return free_pages
 
-    # Очищаем старые объявления
-    await execute_query("DELETE FROM user_listings WHERE timestamp < datetime('now', '-30 days')")
-    logging.info("Удалены объявления старше 30 дней.")
+    async def run(self):
+        started = time.perf_counter()
+        db_pool = await DatabasePool.get_instance()
+        cutoff = f"-{self.retention_days} days"
 
-    # Получаем список пользователей
-    users = await execute_query("SELECT chat_id FROM subscribers", fetchall=True)
-    for (user_id,) in users:
-        await fetch_and_send_listings(user_id, context)
+        deliveries = await self._purge(db_pool, """
+            DELETE FROM deliveries WHERE (user_id, ad_id) IN (
+                SELECT user_id, ad_id FROM deliveries
+                WHERE ts < datetime('now', ?)
+                LIMIT ?
+            )
+        """, cutoff)
+        listings = await self._purge(db_pool, """
+            DELETE FROM listings WHERE ad_id IN (
+                SELECT ad_id FROM listings
+                WHERE first_seen < datetime('now', ?)
+                  AND NOT EXISTS (SELECT 1 FROM deliveries d WHERE d.ad_id = listings.ad_id)
+                LIMIT ?
+            )
+        """, cutoff)
+        # Пакеты для воркеров нужны только до их обработки; строки batch_listings удаляются каскадно
+        batches = await self._purge(db_pool, """
+            DELETE FROM listing_batches WHERE batch_id IN (
+                SELECT batch_id FROM listing_batches
+                WHERE created_at < datetime('now', ?)
+                LIMIT ?
+            )
+        """, f"-{int(os.getenv('BATCH_RETENTION_HOURS', 24))} hours")
+        vacuumed = await self._vacuum(db_pool)
+        if deliveries and SeenIndex._instance is not None:
+            # Удалённые пары остаются в фильтре ложными срабатываниями до перестройки
+            SeenIndex._instance.rebuild()
+
+        self.last_report = {
+            "deliveries_purged": deliveries,
+            "listings_purged": listings,
+            "batches_purged": batches,
+            "pages_vacuumed": vacuumed,
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+        logging.info(f"Очистка старше {self.retention_days} дней: {self.last_report}")
+        return self.last_report
+
+async def run_retention():
+    return await RetentionJob.get_instance().run()
+
+class AdaptiveScheduler:
+    """Планировщик цикла проверки.
+
+    Циклы идут строго последовательно (блокировка не даёт им наложиться),
+    интервал подстраивается под наблюдаемую частоту новых объявлений в
+    пределах [CHECK_INTERVAL_MIN, CHECK_INTERVAL_MAX], а каждый цикл
+    ограничен бюджетом времени: необработанные пользователи переносятся
+    в следующий запуск. Перенос живёт только в памяти, но пока он не пуст,
+    водяной знак не записывается, так что после перезапуска эти объявления
+    будут загружены заново.
+    """
+    _instance = None
+
+    def __init__(self, interval: float, min_interval: float, max_interval: float, budget: float,
+                 target_new: float, shards: int = 0, smoothing: float = 0.3):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min(max(interval, min_interval), max_interval)
+        self.budget = budget
+        self.target_new = target_new
+        # Число процессов-воркеров уведомлений; 0 означает однопроцессный режим
+        self.shards = shards
+        self.smoothing = smoothing
+        self.rate = None
+        self.carry = {}
+        self.lock = asyncio.Lock()
+        self._last_started = None
+        self._task = None
+
+    @classmethod
+    def from_env(cls, **overrides):
+        interval = float(os.getenv('CHECK_INTERVAL', 60))
+        settings = {
+            "interval": interval,
+            "min_interval": float(os.getenv('CHECK_INTERVAL_MIN', min(interval, 20))),
+            "max_interval": float(os.getenv('CHECK_INTERVAL_MAX', max(interval, 600))),
+            "budget": float(os.getenv('CYCLE_BUDGET', 0)),
+            "target_new": float(os.getenv('CHECK_TARGET_NEW_ADS', 3)),
+            "shards": int(os.getenv('NOTIFY_SHARDS', 0)),
+        }
+        return cls(**{**settings, **overrides})
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            cls._instance = cls.from_env()
+        return cls._instance
+
+    def cycle_budget(self):
+        # По умолчанию цикл должен уложиться в 80% текущего интервала
+        return self.budget or 0.8 * self.interval
+
+    def take_carry(self):
+        carry, self.carry = self.carry, {}
+        return carry
+
+    def carry_over(self, leftover):
+        for user_id, listings in leftover.items():
+            self.carry.setdefault(user_id, []).extend(listings)
+
+    def observe(self, new_ads: int, started: float):
+        """Пересчитывает интервал по числу новых объявлений с прошлого цикла."""
+        if self._last_started is not None:
+            elapsed = max(started - self._last_started, 1e-3)
+            rate = new_ads / elapsed
+            self.rate = rate if self.rate is None else self.smoothing * rate + (1 - self.smoothing) * self.rate
+            if self.rate > 0:
+                interval = self.target_new / self.rate
+            else:
+                interval = self.interval * 1.5
+            self.interval = min(max(interval, self.min_interval), self.max_interval)
+        self._last_started = started
+
+    async def run_once(self, context):
+        if self.lock.locked():
+            logging.warning("Предыдущий цикл ещё выполняется, запуск пропущен.")
+            return None
+        async with self.lock:
+            started = time.monotonic()
+            cycle = await scheduled_check(context, deadline=started + self.cycle_budget())
+            self.observe(cycle["counts"].get("ads_new", 0), started)
+            return cycle
+
+    async def _loop(self, context):
+        while True:
+            started = time.monotonic()
+            try:
+                await self.run_once(context)
+            except Exception as e:
+                logging.error(f"Ошибка цикла проверки: {e}")
+            # Перенесённую работу забираем как можно раньше
+            interval = self.min_interval if self.carry else self.interval
+            logging.info(f"Следующий цикл через {interval:.0f} с.")
+            await asyncio.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+    def start(self, context):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop(context))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+async def scheduled_check(context: ContextTypes.DEFAULT_TYPE, deadline=None):
+    logging.info("Запуск регулярной задачи 'scheduled_check'.")
+    cycle = {"stages": {}, "counts": {}}
+    token = current_cycle.set(cycle)
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        outcome = await run_cycle(context, deadline)
+        if not AdaptiveScheduler.get_instance().shards:
+            with stage("notify"):
+                await flush_digests(context)
+    finally:
+        current_cycle.reset(token)
+        CYCLES.inc(outcome=outcome)
+        cycle["outcome"] = outcome
+        cycle["seconds"] = round(time.perf_counter() - started, 4)
+        STAGE_SECONDS.observe(cycle["seconds"], stage="cycle")
+        if os.getenv('METRICS_JSON_LOG'):
+            logging.info(json.dumps({"event": "cycle", **cycle}, ensure_ascii=False))
 
     logging.info("Регулярная задача 'scheduled_check' завершена.")
+    return cycle
+
+async def run_cycle(context, deadline=None):
+    cache = await FilterCache.get_instance()
+    scheduler = AdaptiveScheduler.get_instance()
+    carry = scheduler.take_carry()
+    queries = cache.queries()
+    if not queries:
+        logging.info("Подписчиков нет, загрузка пропущена.")
+        return "idle"
+
+    # Загружаем только те выдачи, на которые есть подписчики, каждую один раз за цикл.
+    # Загрузку не прерываем по бюджету: её ограничивают KUFAR_MAX_PAGES и таймауты HTTP
+    with stage("fetch"):
+        listings_by_query = await fetch_demand(queries)
+    crawl_states = take_pending_crawl_states()
+    if not any(listings_by_query.values()) and not carry:
+        # Выдача не изменилась или запрос не удался (ошибка уже в логе): сопоставление и база не нужны
+        logging.info("Новых объявлений нет, цикл завершён досрочно.")
+        return "unchanged"
+
+    if scheduler.shards:
+        # Сопоставление и отправку выполняют воркеры шардов
+        with stage("persist"):
+            published = await publish_batches(listings_by_query, crawl_states)
+        cycle_count("batches_published", published)
+        return "published"
+
+    # Распределяем объявления по подписчикам через индекс фильтров своего запроса;
+    # перенесённые с прошлого цикла пользователи обрабатываются первыми
+    with stage("match"):
+        merged = {}
+        for user_id, user_listings in carry.items():
+            if user_id in cache.subscribers:
+                merged[user_id] = {listing.ad_id: listing for listing in user_listings}
+        for query, listings in listings_by_query.items():
+            for user_id, user_listings in cache.index(query).route(listings).items():
+                unique = merged.setdefault(user_id, {})
+                for listing in user_listings:
+                    unique.setdefault(listing.ad_id, listing)
+        routed = {user_id: list(unique.values()) for user_id, unique in merged.items()}
+    logging.info(f"Запросов: {len(queries)}, подписчиков: {len(cache.subscribers)}, с совпадениями: {len(routed)}.")
+    cycle_count("matched_users", len(routed))
+    leftover = await save_and_send_batch(routed, context, deadline, crawl_states)
+    scheduler.carry_over(leftover)
+    return "partial" if leftover else "ok"
+
+def shard_of(chat_id, shards):
+    return abs(chat_id) % shards
+
+async def publish_batches(listings_by_query, crawl_states=None):
+    """Ведущий процесс: записывает новые объявления цикла пакетами по запросам
+    вместе с водяными знаками обходов."""
+    db_pool = await DatabasePool.get_instance()
+    published = 0
+    async with db_pool.transaction():
+        for (city, category), listings in listings_by_query.items():
+            if not listings:
+                continue
+            await db_pool.execute(
+                "INSERT INTO listing_batches (city, category) VALUES (?, ?)", (city, category)
+            )
+            (batch_id,) = await db_pool.execute("SELECT last_insert_rowid()", fetch=True)
+            await db_pool.executemany(
+                "INSERT OR IGNORE INTO batch_listings (batch_id, ad_id, payload) VALUES (?, ?, ?)",
+                [(batch_id, listing.ad_id, listing.to_payload()) for listing in listings],
+            )
+            published += 1
+        if crawl_states:
+            await store_crawl_states(db_pool, crawl_states)
+    if crawl_states:
+        commit_crawl_states(crawl_states)
+    logging.info(f"Опубликовано пакетов для воркеров: {published}.")
+    return published
+
+class ShardWorker:
+    """Воркер шарда: обрабатывает пакеты ведущего процесса для своих подписчиков.
+
+    Шард определяется как abs(chat_id) % shards. Прогресс (последний
+    обработанный пакет) хранится в shard_progress, поэтому перезапущенный
+    воркер продолжает с того же места. Фильтры перечитываются раз в
+    FILTER_RELOAD_INTERVAL секунд, так как их меняет процесс с ботом.
+
+    Ошибка итерации (чаще всего блокировка общей базы ведущим процессом)
+    не завершает воркер: итерация повторяется с нарастающей паузой.
+    """
+
+    def __init__(self, shard: int, shards: int, bot):
+        self.shard = shard
+        self.shards = shards
+        self.context = SimpleNamespace(bot=bot)
+        self.poll_interval = float(os.getenv('WORKER_POLL_INTERVAL', 1))
+        self.reload_interval = float(os.getenv('FILTER_RELOAD_INTERVAL', 30))
+        self.max_backoff = float(os.getenv('WORKER_MAX_BACKOFF', 60))
+        self.last_batch_id = None
+
+    async def _load_progress(self):
+        row = await execute_query(
+            "SELECT last_batch_id FROM shard_progress WHERE shard = ? AND shards = ?",
+            (self.shard, self.shards), fetch=True,
+        )
+        if row:
+            return row[0]
+        # Новый воркер не рассылает историю, а начинает с текущего пакета
+        (latest,) = await execute_query("SELECT COALESCE(MAX(batch_id), 0) FROM listing_batches", fetch=True)
+        return latest
+
+    async def _save_progress(self, batch_id):
+        await execute_query("""
+            INSERT INTO shard_progress (shard, shards, last_batch_id)
+            VALUES (?, ?, ?)
+            ON CONFLICT(shard, shards) DO UPDATE SET
+                last_batch_id=excluded.last_batch_id,
+                updated_at=CURRENT_TIMESTAMP
+        """, (self.shard, self.shards, batch_id))
+        self.last_batch_id = batch_id
+
+    async def process_pending(self, cache):
+        batches = await execute_query(
+            "SELECT batch_id, city, category FROM listing_batches WHERE batch_id > ? ORDER BY batch_id LIMIT 50",
+            (self.last_batch_id,), fetchall=True,
+        )
+        for batch_id, city, category in batches:
+            rows = await execute_query(
+                "SELECT payload FROM batch_listings WHERE batch_id = ?", (batch_id,), fetchall=True,
+            )
+            listings = [Listing.from_payload(payload) for (payload,) in rows]
+            with stage("match"):
+                routed = cache.index((city, category)).route(listings)
+            await save_and_send_batch(routed, self.context)
+            await self._save_progress(batch_id)
+        return len(batches)
+
+    async def run(self):
+        FilterCache.shard = (self.shard, self.shards)
+        cache = None
+        reloaded = time.monotonic()
+        failures = 0
+        while True:
+            try:
+                if cache is None:
+                    cache = await FilterCache.get_instance()
+                    self.last_batch_id = await self._load_progress()
+                    logging.info(f"Воркер {self.shard}/{self.shards} запущен с пакета {self.last_batch_id}.")
+                elif time.monotonic() - reloaded > self.reload_interval:
+                    await cache.load()
+                    reloaded = time.monotonic()
+                processed = await self.process_pending(cache)
+                await flush_digests(self.context)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                delay = min(self.max_backoff, self.poll_interval * 2 ** failures)
+                logging.error(f"Ошибка воркера {self.shard}/{self.shards}: {e}. Повтор через {delay:.1f} с.")
+                await asyncio.sleep(delay)
+                continue
+            if not processed:
+                await asyncio.sleep(self.poll_interval)
+
+async def run_worker(shard: int, shards: int):
+    load_dotenv()
+    # Общий лимит Telegram делится между воркерами
+    NotificationDispatcher._instance = NotificationDispatcher.from_env(
+        global_rate=float(os.getenv('TELEGRAM_GLOBAL_RATE', 30)) / shards,
+    )
+
+    db_pool = await DatabasePool.get_instance()
+    await init_db()
+    bot = Bot(os.getenv('TELEGRAM_BOT_TOKEN'))
+    try:
+        async with bot:
+            await ShardWorker(shard, shards, bot).run()
+    finally:
+        await NotificationDispatcher.get_instance().close()
+        await db_pool.close()
+
+def worker_process(shard: int, shards: int):
+    asyncio.run(run_worker(shard, shards))
+
+def start_worker(shard: int, shards: int):
+    process = multiprocessing.get_context("spawn").Process(target=worker_process, args=(shard, shards), daemon=True)
+    process.start()
+    return process
+
+def launch_workers(shards: int):
+    """Запускает воркеры всех шардов отдельными процессами."""
+    processes = [start_worker(shard, shards) for shard in range(shards)]
+    logging.info(f"Запущено воркеров уведомлений: {shards}.")
+    return processes
+
+async def watch_workers(processes):
+    """Перезапускает упавшие воркеры; processes обновляется на месте,
+    чтобы при остановке завершались актуальные процессы."""
+    interval = float(os.getenv('WORKER_CHECK_INTERVAL', 10))
+    shards = len(processes)
+    while True:
+        await asyncio.sleep(interval)
+        for shard, process in enumerate(processes):
+            if not process.is_alive():
+                logging.error(f"Воркер {shard}/{shards} завершился с кодом {process.exitcode}, перезапускаем.")
+                processes[shard] = start_worker(shard, shards)
 
 # Generic function for displaying a menu with a keyboard
 async def show_menu(update: Update, text: str, options: list[list[str]], next_state: int) -> int:
@@ -235,7 +2742,7 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     return await show_menu(update, "Choose an action:", options, MAIN_MENU)
 
 async def show_filter_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    options = [["Цена", "Комнаты"], ["Метро", "Близость к метро"], ["Назад"]]
+    options = [["Цена", "Комнаты"], ["Метро", "Близость к метро"], ["Город", "Категория"], ["Уведомления"], ["Назад"]]
     return await show_menu(update, "Choose a filter to set:", options, FILTER_MENU)
 
 async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -244,6 +2751,7 @@ async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Работа с базой данных через пул соединений
         db_pool = await DatabasePool.get_instance()
         await db_pool.execute("INSERT OR IGNORE INTO subscribers (chat_id) VALUES (?)", (chat_id,))
+        (await FilterCache.get_instance()).subscribe(chat_id)
 
         # Подтверждение подписки
         await update.message.reply_text("Вы успешно подписались на уведомления!")
@@ -259,6 +2767,7 @@ async def unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Работа с базой данных через пул соединений
         db_pool = await DatabasePool.get_instance()
         await db_pool.execute("DELETE FROM subscribers WHERE chat_id = ?", (chat_id,))
+        (await FilterCache.get_instance()).unsubscribe(chat_id)
 
         # Подтверждение отписки
         await update.message.reply_text("Вы успешно отписались от уведомлений.")
@@ -316,6 +2825,7 @@ async def input_max_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 min_price=?,
                 max_price=?
         """, (chat_id, min_price, max_price, min_price, max_price))
+        (await FilterCache.get_instance()).update(chat_id, min_price=min_price, max_price=max_price)
 
         # Подтверждаем установку фильтра
         await update.message.reply_text(f"Фильтр цены установлен: {min_price}-{max_price} BYN.")
@@ -350,6 +2860,7 @@ async def input_rooms(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ON CONFLICT(user_id) DO UPDATE SET
                 rooms=?
         """, (chat_id, rooms, rooms))
+        (await FilterCache.get_instance()).update(chat_id, rooms=rooms)
 
         # Подтверждаем установку фильтра
         await update.message.reply_text(f"Фильтр количества комнат установлен: {rooms}")
@@ -371,8 +2882,13 @@ async def input_metro(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Получение текста сообщения и ID пользователя
-    metro = update.message.text.strip()
     chat_id = update.effective_chat.id
+    station_id = resolve_station(update.message.text.strip())
+    if station_id is None:
+        await update.message.reply_text("Станция не найдена. Проверьте название и попробуйте ещё раз.")
+        return SET_METRO
+    # Сохраняем каноническое название, даже если пользователь ошибся в написании
+    metro = MINSK_METRO_STATIONS[station_id][0]
 
     # Работа с базой данных через пул соединений
     db_pool = await DatabasePool.get_instance()
@@ -382,6 +2898,7 @@ async def input_metro(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ON CONFLICT(user_id) DO UPDATE SET
             metro=?
     """, (chat_id, metro, metro))
+    (await FilterCache.get_instance()).update(chat_id, metro=metro)
 
     # Подтверждаем установку фильтра
     await update.message.reply_text(f"Фильтр по станции метро установлен: {metro}")
@@ -419,11 +2936,127 @@ async def input_near_metro(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ON CONFLICT(user_id) DO UPDATE SET
             near_metro=?
     """, (chat_id, near_metro, near_metro))
+    (await FilterCache.get_instance()).update(chat_id, near_metro=near_metro)
 
     # Подтверждаем установку фильтра
     await update.message.reply_text(f"Фильтр близости к метро установлен: {'Рядом с метро' if near_metro else 'Не важно'}")
     return await show_filter_menu(update, context)
 
+async def set_city_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    names = [name for name, _ in KUFAR_CITIES.values()]
+    keyboard = [names[i:i + 3] for i in range(0, len(names), 3)] + [["Назад"]]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+    await update.message.reply_text("Выберите город:", reply_markup=reply_markup)
+    return SET_CITY
+
+async def input_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Проверка команды "Назад"
+    if await check_back_command(update, context, show_filter_menu):
+        return
+
+    choice = update.message.text.strip()
+    chat_id = update.effective_chat.id
+
+    city = next((slug for slug, (name, _) in KUFAR_CITIES.items() if name == choice), None)
+    if city is None:
+        await update.message.reply_text("Пожалуйста, выберите город из меню.")
+        return SET_CITY
+
+    # Работа с базой данных через пул соединений
+    db_pool = await DatabasePool.get_instance()
+    await db_pool.execute("""
+        INSERT INTO user_filters (user_id, city)
+        VALUES (?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            city=?
+    """, (chat_id, city, city))
+    (await FilterCache.get_instance()).update(chat_id, city=city)
+
+    # Подтверждаем установку фильтра
+    await update.message.reply_text(f"Город установлен: {choice}")
+    return await show_filter_menu(update, context)
+
+async def set_category_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    keyboard = [[name] for name, _ in KUFAR_CATEGORIES.values()] + [["Назад"]]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+    await update.message.reply_text("Выберите категорию:", reply_markup=reply_markup)
+    return SET_CATEGORY
+
+async def input_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Проверка команды "Назад"
+    if await check_back_command(update, context, show_filter_menu):
+        return
+
+    choice = update.message.text.strip()
+    chat_id = update.effective_chat.id
+
+    category = next((slug for slug, (name, _) in KUFAR_CATEGORIES.items() if name == choice), None)
+    if category is None:
+        await update.message.reply_text("Пожалуйста, выберите категорию из меню.")
+        return SET_CATEGORY
+
+    # Работа с базой данных через пул соединений
+    db_pool = await DatabasePool.get_instance()
+    await db_pool.execute("""
+        INSERT INTO user_filters (user_id, category)
+        VALUES (?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            category=?
+    """, (chat_id, category, category))
+    (await FilterCache.get_instance()).update(chat_id, category=category)
+
+    # Подтверждаем установку фильтра
+    await update.message.reply_text(f"Категория установлена: {choice}")
+    return await show_filter_menu(update, context)
+
+# Режимы уведомлений: подпись кнопки -> digest_interval
+DIGEST_OPTIONS = {
+    "Каждое объявление отдельно": None,
+    "Дайджест за цикл": 0,
+    "Дайджест раз в 15 минут": 15,
+    "Дайджест раз в час": 60,
+}
+
+def digest_label(digest_interval):
+    if digest_interval is None:
+        return "Каждое объявление отдельно"
+    if digest_interval == 0:
+        return "Дайджест за цикл"
+    return f"Дайджест раз в {digest_interval} мин."
+
+async def set_digest_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    keyboard = [[label] for label in DIGEST_OPTIONS] + [["Назад"]]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+    await update.message.reply_text("Как присылать новые объявления?", reply_markup=reply_markup)
+    return SET_DIGEST
+
+async def input_digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Проверка команды "Назад"
+    if await check_back_command(update, context, show_filter_menu):
+        return
+
+    choice = update.message.text.strip()
+    chat_id = update.effective_chat.id
+
+    if choice not in DIGEST_OPTIONS:
+        await update.message.reply_text("Пожалуйста, выберите режим из меню.")
+        return SET_DIGEST
+    digest_interval = DIGEST_OPTIONS[choice]
+
+    # Работа с базой данных через пул соединений
+    db_pool = await DatabasePool.get_instance()
+    await db_pool.execute("""
+        INSERT INTO user_filters (user_id, digest_interval)
+        VALUES (?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            digest_interval=?
+    """, (chat_id, digest_interval, digest_interval))
+    (await FilterCache.get_instance()).update(chat_id, digest_interval=digest_interval)
+
+    # Подтверждаем установку режима
+    await update.message.reply_text(f"Режим уведомлений: {choice}")
+    return await show_filter_menu(update, context)
+
 # Показ текущих фильтров
 async def show_current_filters(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
@@ -432,20 +3065,23 @@ async def show_current_filters(update: Update, context: ContextTypes.DEFAULT_TYP
 
     # Выполняем запрос на выборку фильтров
     filters = await db_pool.execute("""
-        SELECT min_price, max_price, rooms, metro, near_metro
+        SELECT min_price, max_price, rooms, metro, near_metro, city, category, digest_interval
         FROM user_filters WHERE user_id = ?
     """, (chat_id,), fetch=True)
 
     # Формируем сообщение на основе полученных фильтров
     if filters:
-        min_price, max_price, rooms, metro, near_metro = filters
+        min_price, max_price, rooms, metro, near_metro, city, category, digest_interval = filters
         message = (
             f"Текущие фильтры:\n"
+            f"Город: {KUFAR_CITIES.get(city or DEFAULT_CITY, (city,))[0]}\n"
+            f"Категория: {KUFAR_CATEGORIES.get(category or DEFAULT_CATEGORY, (category,))[0]}\n"
             f"Минимальная цена: {min_price or 'Не установлена'}\n"
             f"Максимальная цена: {max_price or 'Не установлена'}\n"
             f"Количество комнат: {rooms or 'Не установлено'}\n"
             f"Станция метро: {metro or 'Не установлена'}\n"
-            f"Близость к метро: {('Рядом с метро' if near_metro else 'Не важно') if near_metro is not None else 'Не установлена'}"
+            f"Близость к метро: {('Рядом с метро' if near_metro else 'Не важно') if near_metro is not None else 'Не установлена'}\n"
+            f"Уведомления: {digest_label(digest_interval)}"
         )
     else:
         message = "Фильтры не установлены."
@@ -459,6 +3095,8 @@ async def show_reset_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         ["Сбросить цену", "Сбросить количество комнат"],
         ["Сбросить метро", "Сбросить близость к метро"],
+        ["Сбросить город", "Сбросить категорию"],
+        ["Сбросить режим уведомлений"],
         ["Сбросить все фильтры", "Назад"]
     ]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
@@ -471,29 +3109,53 @@ async def reset_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
 
     db_pool = await DatabasePool.get_instance()  # Получаем экземпляр пула базы данных
+    cache = await FilterCache.get_instance()
 
     if choice == "Сбросить цену":
         await db_pool.execute("""
             UPDATE user_filters SET min_price = NULL, max_price = NULL WHERE user_id = ?
         """, (chat_id,))
+        cache.clear(chat_id, 'min_price', 'max_price')
         await update.message.reply_text("Фильтр цены сброшен.")
     elif choice == "Сбросить количество комнат":
         await db_pool.execute("""
             UPDATE user_filters SET rooms = NULL WHERE user_id = ?
         """, (chat_id,))
+        cache.clear(chat_id, 'rooms')
         await update.message.reply_text("Фильтр количества комнат сброшен.")
     elif choice == "Сбросить метро":
         await db_pool.execute("""
             UPDATE user_filters SET metro = NULL WHERE user_id = ?
         """, (chat_id,))
+        cache.clear(chat_id, 'metro')
         await update.message.reply_text("Фильтр по станции метро сброшен.")
     elif choice == "Сбросить близость к метро":
         await db_pool.execute("""
             UPDATE user_filters SET near_metro = NULL WHERE user_id = ?
         """, (chat_id,))
+        cache.clear(chat_id, 'near_metro')
         await update.message.reply_text("Фильтр близости к метро сброшен.")
+    elif choice == "Сбросить город":
+        await db_pool.execute("""
+            UPDATE user_filters SET city = NULL WHERE user_id = ?
+        """, (chat_id,))
+        cache.clear(chat_id, 'city')
+        await update.message.reply_text("Город сброшен на Минск.")
+    elif choice == "Сбросить категорию":
+        await db_pool.execute("""
+            UPDATE user_filters SET category = NULL WHERE user_id = ?
+        """, (chat_id,))
+        cache.clear(chat_id, 'category')
+        await update.message.reply_text("Категория сброшена на квартиры на длительный срок.")
+    elif choice == "Сбросить режим уведомлений":
+        await db_pool.execute("""
+            UPDATE user_filters SET digest_interval = NULL WHERE user_id = ?
+        """, (chat_id,))
+        cache.clear(chat_id, 'digest_interval')
+        await update.message.reply_text("Объявления снова приходят по одному.")
     elif choice == "Сбросить все фильтры":
         await db_pool.execute("DELETE FROM user_filters WHERE user_id = ?", (chat_id,))
+        cache.remove(chat_id)
         await update.message.reply_text("Все фильтры сброшены.")
         return await show_main_menu(update, context)
     elif choice == "Назад":
@@ -523,7 +3185,7 @@ async def check_back_command(update: Update, context: ContextTypes.DEFAULT_TYPE,
     return False
 
 
-async def main():
+async def main(mode: str = "polling", shards: int | None = None):
     load_dotenv()
     TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 
@@ -533,8 +3195,32 @@ async def main():
     # Инициализация базы данных
     await init_db()
 
+    # Загружаем фильтры и подписчиков в память одним проходом
+    await FilterCache.get_instance()
+
+    # Метрики: очередь уведомлений и пул базы читаются в момент запроса
+    METRICS.gauge("parsbot_send_queue_depth", "Chats waiting in the notification queue",
+                  lambda: NotificationDispatcher.get_instance().queue.qsize())
+    METRICS.gauge("parsbot_db_readers_in_use", "Reader connections in use",
+                  lambda: db_pool.stats()["readers_in_use"])
+    METRICS.gauge("parsbot_db_write_queue", "Tasks waiting for the writer connection",
+                  lambda: db_pool.stats()["write_queue"])
+    METRICS.gauge("parsbot_seen_index_bytes", "Memory used by the delivered-pairs Bloom filter",
+                  lambda: len(SeenIndex._instance.bits) if SeenIndex._instance else 0)
+    metrics_server = await start_metrics_server()
+    start_capture()
+
     # Создаем приложение
-    app = ApplicationBuilder().token(TOKEN).build()
+    # Диалоги и user_data переживают перезапуск: читаются из базы одним запросом при старте
+    persistence = SQLitePersistence(
+        update_interval=float(os.getenv('PERSISTENCE_INTERVAL', 5)),
+        debounce=float(os.getenv('PERSISTENCE_DEBOUNCE', 0.5)),
+    )
+    builder = ApplicationBuilder().token(TOKEN).persistence(persistence)
+    if mode == "webhook":
+        # Ограниченная очередь при последовательной обработке даёт вебхуку обратное давление
+        builder = builder.update_queue(asyncio.Queue(maxsize=int(os.getenv('WEBHOOK_QUEUE_SIZE', 256))))
+    app = builder.build()
 
     # Обработчик состояний через ConversationHandler
     conv_handler = ConversationHandler(
@@ -552,6 +3238,9 @@ async def main():
                 MessageHandler(filters.Regex("^Количество комнат$"), set_rooms_filter),
                 MessageHandler(filters.Regex("^Метро$"), set_metro_filter),
                 MessageHandler(filters.Regex("^Близость к метро$"), set_near_metro_filter),
+                MessageHandler(filters.Regex("^Город$"), set_city_filter),
+                MessageHandler(filters.Regex("^Категория$"), set_category_filter),
+                MessageHandler(filters.Regex("^Уведомления$"), set_digest_filter),
                 MessageHandler(filters.Regex("^Назад$"), show_main_menu),
             ],
             SET_MIN_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, input_min_price)],
@@ -560,19 +3249,101 @@ async def main():
             SET_METRO: [MessageHandler(filters.TEXT & ~filters.COMMAND, input_metro)],
             SET_NEAR_METRO: [MessageHandler(filters.TEXT & ~filters.COMMAND, input_near_metro)],
             RESET_MENU: [MessageHandler(filters.TEXT & ~filters.COMMAND, reset_filter)],
+            SET_CITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, input_city)],
+            SET_CATEGORY: [MessageHandler(filters.TEXT & ~filters.COMMAND, input_category)],
+            SET_DIGEST: [MessageHandler(filters.TEXT & ~filters.COMMAND, input_digest)],
         },
         fallbacks=[CommandHandler('start', start)],
+        name="main",
+        persistent=True,
     )
 
     app.add_handler(conv_handler)
 
     # Настраиваем планировщик
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(scheduled_check, 'interval', seconds=int(os.getenv('CHECK_INTERVAL', 60)), args=[app])
+    scheduler.add_job(run_retention, 'interval', seconds=int(os.getenv('RETENTION_INTERVAL', 3600)))
     scheduler.start()
 
+    # Цикл проверки идёт на собственном адаптивном планировщике
+    if shards is not None:
+        AdaptiveScheduler._instance = AdaptiveScheduler.from_env(shards=shards)
+    scheduler = AdaptiveScheduler.get_instance()
+    scheduler.start(app)
+
+    # В шардированном режиме этот процесс только публикует пакеты, рассылают воркеры
+    workers = launch_workers(scheduler.shards) if scheduler.shards else []
+    watcher = asyncio.create_task(watch_workers(workers)) if workers else None
+
     # Запускаем приложение
     try:
-        await app.run_polling()
+        if mode == "webhook":
+            await run_webhook(app)
+        else:
+            await app.run_polling()
     finally:
+        await AdaptiveScheduler.get_instance().stop()
+        if watcher:
+            watcher.cancel()
+            await asyncio.gather(watcher, return_exceptions=True)
+        for worker in workers:
+            worker.terminate()
+        if metrics_server:
+            metrics_server.close()
+        await NotificationDispatcher.get_instance().close()
+        await KufarClient.get_instance().close()
         await db_pool.close()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Telegram-бот уведомлений о квартирах Kufar.")
+    commands = parser.add_subparsers(dest="command")
+
+    bot_parser = commands.add_parser("bot", help="бот и цикл проверки (по умолчанию)")
+    bot_parser.add_argument("--shards", type=int, default=None,
+                            help="число процессов-воркеров уведомлений (0 — всё в одном процессе)")
+
+    worker_parser = commands.add_parser("worker", help="один воркер уведомлений")
+    worker_parser.add_argument("--shard", type=int, required=True)
+    worker_parser.add_argument("--shards", type=int, required=True)
+
+    workers_parser = commands.add_parser("workers", help="все воркеры уведомлений без бота")
+    workers_parser.add_argument("--shards", type=int, required=True)
+
+    webhook_parser = commands.add_parser("webhook", help="бот в режиме вебхука (WEBHOOK_* в окружении)")
+    webhook_parser.add_argument("--shards", type=int, default=None,
+                                help="число процессов-воркеров уведомлений (0 — всё в одном процессе)")
+
+    replay_parser = commands.add_parser("replay", help="прогнать цикл проверки по записанным ответам Kufar")
+    replay_parser.add_argument("file", help="запись KUFAR_CAPTURE_PATH (JSON на строку)")
+    replay_parser.add_argument("--db", required=True, help="база для прогона, обычно копия user_data.db")
+    replay_parser.add_argument("--speed", type=float, default=0,
+                               help="1 — паузы как при записи, N — в N раз быстрее, 0 — без пауз")
+    replay_parser.add_argument("--reset-watermarks", action="store_true",
+                               help="забыть водяные знаки, чтобы объявления записи считались новыми")
+    replay_parser.add_argument("--output", help="куда записать отчёт по циклам (JSON)")
+
+    post_parser = commands.add_parser("post-updates", help="отправить записанные обновления на локальный вебхук")
+    post_parser.add_argument("file", help="JSON-обновления Telegram, по одному на строку")
+    post_parser.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "worker":
+        worker_process(args.shard, args.shards)
+    elif args.command == "workers":
+        for process in launch_workers(args.shards):
+            process.join()
+    elif args.command == "replay":
+        report = asyncio.run(replay_capture(args.file, args.db, args.speed, args.reset_watermarks))
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Циклов: {report['cycles']}, сообщений: {report['messages']}")
+    elif args.command == "post-updates":
+        load_dotenv()
+        post_updates(args.file, args.url, os.getenv('WEBHOOK_SECRET'))
+    else:
+        # run_polling запускает собственный цикл событий внутри main()
+        nest_asyncio.apply()
+        asyncio.run(main("webhook" if args.command == "webhook" else "polling", getattr(args, "shards", None)))